@@ -1,4 +1,7 @@
 #include <stdio.h>
+#include <ctype.h>
+#include <errno.h>
+#include <math.h>
 #include <netdb.h>
 #include <assert.h>
 #include <string.h>
@@ -7,29 +10,209 @@
 #include <openssl/sha.h>
 #include "tada.h"
 
-void _submit(test_t test, char *msg_buf, size_t cnt)
+#define BATCH_HEAD "{\"msg-type\": \"batch\", \"msgs\": ["
+#define BATCH_TAIL "]}"
+#define BATCH_HEAD_LEN (sizeof(BATCH_HEAD) - 1)
+#define BATCH_TAIL_LEN (sizeof(BATCH_TAIL) - 1)
+
+/* tadad address, resolved once for all tests */
+static pthread_once_t tada_addr_once = PTHREAD_ONCE_INIT;
+static struct sockaddr_storage tada_sa;
+static socklen_t tada_sa_len;
+
+static void tada_addr_resolve(void)
 {
+	char *tada_addr = getenv("TADA_ADDR");
+	char *tada_host = TADAD_HOST;
+	char tada_port[16];
+	struct addrinfo hints = {
+		.ai_family = AF_UNSPEC,
+		.ai_socktype = SOCK_DGRAM,
+	};
+	struct addrinfo *ai;
 	int rc;
+
+	snprintf(tada_port, sizeof(tada_port), "%d", TADAD_PORT);
+	if (tada_addr) {
+		char *s = strdup(tada_addr);
+		char *port;
+		tada_host = strtok(s, ":");
+		port = strtok(NULL, ":");
+		if (port)
+			snprintf(tada_port, sizeof(tada_port), "%s", port);
+	}
+	rc = getaddrinfo(tada_host, tada_port, &hints, &ai);
+	if (rc) {
+		fprintf(stderr, "Cannot resolve the TADA server address "
+				"'%s:%s', %s.\n", tada_host, tada_port,
+				gai_strerror(rc));
+	}
+	assert(rc == 0);
+	memcpy(&tada_sa, ai->ai_addr, ai->ai_addrlen);
+	tada_sa_len = ai->ai_addrlen;
+	freeaddrinfo(ai);
+}
+
+/*
+ * Copy `src` into `dst` (of `sz` bytes) as the content of a JSON string,
+ * escaping '"', '\\' and the control characters. The result is truncated to
+ * fit in `dst` without cutting a character or an escape sequence. Returns
+ * `dst`.
+ */
+static char *json_esc(char *dst, size_t sz, const char *src)
+{
+	char *e = dst;
+	char *end = dst + sz - 1; /* room for '\0' */
+	const unsigned char *s;
+
+	for (s = (const unsigned char *)src; *s; s++) {
+		if (*s == '"' || *s == '\\') {
+			if (end - e < 2)
+				goto trunc;
+			*e++ = '\\';
+			*e++ = *s;
+		} else if (*s < 0x20) {
+			if (end - e < 6)
+				goto trunc;
+			e += sprintf(e, "\\u%04x", *s);
+		} else {
+			if (e >= end)
+				goto trunc;
+			*e++ = *s;
+		}
+	}
+	*e = '\0';
+	return dst;
+ trunc:
+	/* drop the last UTF-8 character, it may have been cut */
+	while (e > dst && (e[-1] & 0xC0) == 0x80)
+		e--;
+	if (e > dst && (e[-1] & 0x80))
+		e--;
+	*e = '\0';
+	return dst;
+}
+
+/*
+ * Check that `s` is a single JSON object, so that it cannot break the
+ * message it is embedded in. Only the structure is checked: the brackets
+ * are balanced and the strings are terminated, without control characters.
+ */
+static int json_obj_check(const char *s)
+{
+	char stack[32];
+	int depth = 0;
+
+	while (isspace((unsigned char)*s))
+		s++;
+	if (*s != '{')
+		return EINVAL;
+	for (; *s; s++) {
+		switch (*s) {
+		case '{':
+		case '[':
+			if (depth == sizeof(stack))
+				return EINVAL;
+			stack[depth++] = *s == '{' ? '}' : ']';
+			break;
+		case '}':
+		case ']':
+			if (!depth || stack[--depth] != *s)
+				return EINVAL;
+			if (!depth)
+				goto end;
+			break;
+		case '"':
+			for (s++; *s != '"'; s++) {
+				if (!*s || (unsigned char)*s < 0x20)
+					return EINVAL;
+				if (*s == '\\' && !*++s)
+					return EINVAL;
+			}
+			break;
+		}
+	}
+	return EINVAL;
+ end:
+	for (s++; isspace((unsigned char)*s); s++)
+		;
+	return *s ? EINVAL : 0;
+}
+
+/* Send the buffered messages, test->lock is held */
+static void _flush(test_t test)
+{
+	int rc;
+	char *data = test->batch_buf;
+	size_t len = test->batch_len;
+
+	if (!test->batch_cnt)
+		return;
+	if (test->batch_cnt == 1) {
+		/* send the only message as-is */
+		data += BATCH_HEAD_LEN;
+		len -= BATCH_HEAD_LEN;
+	} else {
+		memcpy(data + len, BATCH_TAIL, BATCH_TAIL_LEN);
+		len += BATCH_TAIL_LEN;
+	}
+	rc = sendto(test->udp_fd, data, len, 0,
+		    (struct sockaddr *)&test->sa, test->sa_len);
+	if (rc < 0) {
+		fprintf(stderr, "Failed to send %d messages to "
+				"the TADA server, errno %d.\n",
+				test->batch_cnt, errno);
+	}
+	test->batch_len = 0;
+	test->batch_cnt = 0;
+}
+
+/* Buffer the message and write it to the log, test->lock is held */
+static void _submit(test_t test, char *msg_buf, size_t cnt)
+{
 	FILE *log = stdout;
-	static int line_no = 0;
+	struct timespec now;
+
 	if (test->flags & TADA_TEST_F_SEND_RESULT) {
-		rc = sendto(test->udp_fd, msg_buf, cnt, 0,
-				(struct sockaddr *)&test->sin,
-				sizeof(test->sin));
-		if (rc < 0) {
-			fprintf(stderr, "Failed to send a message to "
-					"the TADA server, error %d.\n", rc);
+		if (test->batch_cnt && test->batch_len + 1 + cnt +
+				BATCH_TAIL_LEN > TADA_MAX_DATAGRAM)
+			_flush(test);
+		clock_gettime(CLOCK_MONOTONIC, &now);
+		if (!test->batch_cnt) {
+			memcpy(test->batch_buf, BATCH_HEAD, BATCH_HEAD_LEN);
+			test->batch_len = BATCH_HEAD_LEN;
+			test->batch_ts = now;
+		} else {
+			test->batch_buf[test->batch_len++] = ',';
 		}
+		memcpy(test->batch_buf + test->batch_len, msg_buf, cnt);
+		test->batch_len += cnt;
+		test->batch_cnt++;
+		if (now.tv_sec - test->batch_ts.tv_sec >= TADA_FLUSH_INTERVAL)
+			_flush(test);
 	}
 
 	if (test->flags & TADA_TEST_F_LOG_RESULT) {
 		if (test->log_file)
 			log = test->log_file;
-		if (line_no > 0)
+		if (test->line_no > 0)
 			fprintf(log, ",\n");
 		fprintf(log, "%s\n", msg_buf);
 	}
-	line_no++;
+	test->line_no++;
+}
+
+/*
+ * Send the buffered messages to the TADA server, and write out the buffered
+ * log. This is also done by tada_finish().
+ */
+void tada_flush(test_t test)
+{
+	pthread_mutex_lock(&test->lock);
+	_flush(test);
+	if (test->log_file)
+		fflush(test->log_file);
+	pthread_mutex_unlock(&test->lock);
 }
 
 /*
@@ -44,19 +227,21 @@ void tada_start(test_t test)
 {
 	size_t cnt;
 	char msg_buf[1024];
-	char *tada_addr = getenv("TADA_ADDR");
-	char *tada_host;
-	short tada_port;
-	struct hostent *h;
 	unsigned char md[32];
 	int i;
 	time_t ts;
 	FILE *f = stdout;
 
+	pthread_mutex_init(&test->lock, NULL);
+	test->line_no = 0;
+	test->batch_len = 0;
+	test->batch_cnt = 0;
 	if (test->flags & TADA_TEST_F_LOG_RESULT) {
 		if (test->log_path) {
 			test->log_file = fopen(test->log_path, "w");
 			if (test->log_file) {
+				setvbuf(test->log_file, NULL, _IOFBF,
+					TADA_LOG_BUFSZ);
 				f = test->log_file;
 			} else {
 				fprintf(stderr, "Failed to open the log file '%s'. "
@@ -68,17 +253,17 @@ void tada_start(test_t test)
 	}
 
 
-	if (!tada_addr) {
-		tada_host = TADAD_HOST;
-		tada_port = htons(TADAD_PORT);
+	if (test->flags & TADA_TEST_F_SEND_RESULT) {
+		pthread_once(&tada_addr_once, tada_addr_resolve);
+		memcpy(&test->sa, &tada_sa, tada_sa_len);
+		test->sa_len = tada_sa_len;
+		test->batch_buf = malloc(TADA_MAX_DATAGRAM);
+		assert(test->batch_buf);
+		test->udp_fd = socket(test->sa.ss_family, SOCK_DGRAM, 0);
+		assert(test->udp_fd >= 0);
 	} else {
-		char *s = strdup(tada_addr);
-		tada_host = strtok(s, ":");
-		tada_port = htons(atoi(strtok(NULL, ":")));
+		test->udp_fd = -1;
 	}
-	h = gethostbyname(tada_host);
-	assert(h);
-	assert (h->h_addrtype == AF_INET);
 
 	ts = time(NULL);
 
@@ -96,10 +281,6 @@ void tada_start(test_t test)
 		snprintf(&test->test_id[i*2], 3, "%02hhx", md[i]);
 	}
 
-	test->sin.sin_addr.s_addr = *(unsigned int *)(h->h_addr_list[0]);
-	test->sin.sin_family = h->h_addrtype;
-	test->sin.sin_port = tada_port;
-
 	cnt = snprintf(msg_buf, sizeof(msg_buf),
 		       "{ \"msg-type\" : \"test-start\","
 		       "\"test-suite\" : \"%s\","
@@ -121,17 +302,20 @@ void tada_start(test_t test)
 		       test->test_id
 		       );
 	assert(cnt < sizeof(msg_buf));
-	test->udp_fd = socket(AF_INET, SOCK_DGRAM, 0);
-	assert(test->udp_fd >= 0);
+	test->metric_no = 0;
+	pthread_mutex_lock(&test->lock);
 	_submit(test, msg_buf, cnt);
+	pthread_mutex_unlock(&test->lock);
 }
 
 void tada_finish(test_t test)
 {
 	size_t cnt;
 	char msg_buf[1024];
+	char desc_buf[512];
 	int assert_no;
 
+	pthread_mutex_lock(&test->lock);
 	/*
 	 * Go through the list of all test assertions and send status
 	 * for un-tested assertions.
@@ -149,7 +333,8 @@ void tada_finish(test_t test)
 			       "}",
 			       test->test_id,
 			       assert_no,
-			       test->test_asserts[assert_no].description
+			       json_esc(desc_buf, sizeof(desc_buf),
+				  test->test_asserts[assert_no].description)
 			       );
 		assert(cnt < sizeof(msg_buf));
 		_submit(test, msg_buf, cnt);
@@ -165,37 +350,32 @@ void tada_finish(test_t test)
 		       );
 	assert(cnt < sizeof(msg_buf));
 	_submit(test, msg_buf, cnt);
-	close(test->udp_fd);
+	_flush(test);
+	if (test->udp_fd >= 0)
+		close(test->udp_fd);
 	test->udp_fd = -1;
+	free(test->batch_buf);
+	test->batch_buf = NULL;
 	if (test->log_file) {
 		fprintf(test->log_file, "]");
 		fclose(test->log_file);
+		test->log_file = NULL;
 	} else {
 		fprintf(stdout, "]");
 	}
-
+	pthread_mutex_unlock(&test->lock);
 }
 
 int tada_assert(test_t test, int assert_no, int cond, const char *cond_str)
 {
 	size_t cnt;
 	char msg_buf[1024];
-	char esc_str[512];
-	const char *s;
-	char *e;
-
-	/* Escape any embedded '"' in the cond_str */
-	for (s = cond_str, e = esc_str; *s != '\0'; s++) {
-		if (*s == '"') {
-			*e++ = '\\';
-			*e++ = '"';
-		} else {
-			*e++ = *s;
-		}
-	}
-	*e = '\0';
+	char esc_str[384];
+	char desc_buf[384];
 
+	json_esc(esc_str, sizeof(esc_str), cond_str);
 	assert(test->test_asserts[assert_no].test);
+	pthread_mutex_lock(&test->lock);
 	if (cond)
 		test->test_asserts[assert_no].result = TEST_PASSED;
 	else
@@ -210,11 +390,85 @@ int tada_assert(test_t test, int assert_no, int cond, const char *cond_str)
 		       "}",
 		       test->test_id,
 		       assert_no,
-		       test->test_asserts[assert_no].description,
+		       json_esc(desc_buf, sizeof(desc_buf),
+				test->test_asserts[assert_no].description),
 		       esc_str,
 		       test->test_asserts[assert_no].result == TEST_PASSED ? "passed" : "failed"
 		       );
 	assert(cnt < sizeof(msg_buf));
 	_submit(test, msg_buf, cnt);
+	pthread_mutex_unlock(&test->lock);
 	return cond;
 }
+
+/*
+ * { "msg-type" : "metric",
+ *   "test-id" : <test-id>,
+ *   "metric-no" : <metric-no>,
+ *   "metric-name" : <name>,
+ *   "metric-value" : <value>,
+ *   "metric-unit" : <unit>,
+ *   "metric-tags" : <tags_json>,
+ *   "timestamp" : <timestamp>
+ * }
+ *
+ * `unit` and `tags_json` may be NULL. `tags_json` is a JSON object text, e.g.
+ * "{\"xprt\":\"sock\"}". Returns 0 on success, or EINVAL if `value` is not a
+ * finite number (not representable in JSON).
+ */
+int tada_metric(test_t test, const char *name, double value,
+		const char *unit, const char *tags_json)
+{
+	size_t cnt;
+	char msg_buf[1024];
+	char name_buf[256];
+	char unit_buf[256];
+	char esc_buf[192];
+	struct timespec ts;
+
+	if (!isfinite(value)) {
+		fprintf(stderr, "TADA metric '%s' value is not finite, "
+				"the metric is not recorded.\n", name);
+		return EINVAL;
+	}
+	if (tags_json && json_obj_check(tags_json)) {
+		fprintf(stderr, "TADA metric '%s' tags are not a JSON object, "
+				"the metric is not recorded.\n", name);
+		return EINVAL;
+	}
+	if (unit)
+		snprintf(unit_buf, sizeof(unit_buf), "\"%s\"",
+			 json_esc(esc_buf, sizeof(esc_buf), unit));
+	else
+		snprintf(unit_buf, sizeof(unit_buf), "null");
+	clock_gettime(CLOCK_REALTIME, &ts);
+	pthread_mutex_lock(&test->lock);
+	cnt = snprintf(msg_buf, sizeof(msg_buf),
+		       "{ \"msg-type\" : \"metric\","
+		       "\"test-id\" : \"%s\","
+		       "\"metric-no\" : %d,"
+		       "\"metric-name\" : \"%s\","
+		       "\"metric-value\" : %.17g,"
+		       "\"metric-unit\" : %s,"
+		       "\"metric-tags\" : %s,"
+		       "\"timestamp\" : %ld.%06ld"
+		       "}",
+		       test->test_id,
+		       test->metric_no,
+		       json_esc(name_buf, sizeof(name_buf), name),
+		       value,
+		       unit_buf,
+		       tags_json ? tags_json : "null",
+		       ts.tv_sec, ts.tv_nsec / 1000
+		       );
+	if (cnt >= sizeof(msg_buf)) {
+		pthread_mutex_unlock(&test->lock);
+		fprintf(stderr, "TADA metric '%s' tags are too long, "
+				"the metric is not recorded.\n", name);
+		return EINVAL;
+	}
+	test->metric_no++;
+	_submit(test, msg_buf, cnt);
+	pthread_mutex_unlock(&test->lock);
+	return 0;
+}
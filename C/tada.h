@@ -4,8 +4,10 @@
 #include <sys/types.h>
 #include <sys/socket.h>
 #include <netinet/in.h>
+#include <pthread.h>
 #include <stdlib.h>
 #include <stdio.h>
+#include <time.h>
 
 typedef enum test_result {
 	TEST_PASSED = 0,
@@ -30,11 +32,19 @@ typedef struct test_s {
 	const char *commit_id;
 	const char *test_desc;
 	char test_id[65];
-	struct sockaddr_in sin;
+	struct sockaddr_storage sa;	/* tadad address */
+	socklen_t sa_len;
 	int udp_fd;
 	char *log_path;
 	FILE *log_file;
 	int flags;
+	int metric_no;
+	int line_no;		/* the number of messages logged */
+	pthread_mutex_t lock;	/* serializes the reporting threads */
+	char *batch_buf;	/* the messages waiting to be sent */
+	size_t batch_len;
+	int batch_cnt;
+	struct timespec batch_ts; /* when the first message was buffered */
 	struct test_assertion_s *test_asserts;
 } *test_t;
 
@@ -43,6 +53,20 @@ typedef struct test_s {
 #define TADAD_HOST	"localhost"
 #define TADAD_PORT	9862
 
+/*
+ * The messages are packed into batch datagrams of up to TADA_MAX_DATAGRAM
+ * bytes, i.e. { "msg-type": "batch", "msgs": [ MSG0, MSG1, ... ] }. The
+ * buffered messages are sent when the datagram is full, when a message is
+ * reported TADA_FLUSH_INTERVAL seconds after the first buffered one, and by
+ * tada_flush() and tada_finish(). There is no timer: the messages of a test
+ * that stops reporting stay buffered until tada_flush() or tada_finish(), so
+ * a test should call TEST_FLUSH() before a long wait and must call
+ * TEST_FINISH() before it exits.
+ */
+#define TADA_MAX_DATAGRAM	(32*1024)
+#define TADA_FLUSH_INTERVAL	1
+#define TADA_LOG_BUFSZ		(64*1024)
+
 #define TEST_BEGIN(_suite_name, _test_name, _test_type, _test_user, \
 		   _commit_id, _test_desc, _log_path, _flags, c_name) \
 	struct test_s c_name = {			    \
@@ -68,9 +92,15 @@ typedef struct test_s {
 
 extern void tada_start(test_t test);
 extern void tada_finish(test_t test);
+extern void tada_flush(test_t test);
 extern int tada_assert(test_t test, int assert_no, int cond, const char *cond_str);
+extern int tada_metric(test_t test, const char *name, double value,
+		       const char *unit, const char *tags_json);
 #define TEST_START(c_name) tada_start(&c_name)
 #define TEST_FINISH(c_name) tada_finish(&c_name)
+#define TEST_FLUSH(c_name) tada_flush(&c_name)
 #define TEST_ASSERT(_t_, _no_, _cond_) tada_assert(&_t_, _no_, _cond_, #_cond_)
+#define TEST_METRIC(_t_, _name_, _value_, _unit_) \
+	tada_metric(&_t_, _name_, _value_, _unit_, NULL)
 
 #endif
@@ -30,6 +30,7 @@ from distutils.spawn import find_executable
 from configparser import ConfigParser, ExtendedInterpolation
 
 from functools import reduce
+from itertools import repeat
 
 # `D` Debug object to store values for debugging
 class Debug(object): pass
@@ -93,18 +94,25 @@ _META_END = r'(?:^(?P<meta_end>[=]+)$)'
 _LS_L_HDR = r'(?:(?P<set_name>[^:]+): .* last update: (?P<ts>.*))'
 _LS_L_DATA = r'(?:(?P<F>.) (?P<type>\S+)\s+(?P<metric_name>\S+)\s+' \
              r'(?P<metric_value>.*))'
-_LS_RE = re.compile(
-            _PRE_META_KV + "|" +
-            _META_BEGIN + "|" +
-            _META_DASHES + "|" +
-            _META_DATA + "|" +
-            _META_SUMMARY + "|" +
-            _META_END + "|" +
-            _LS_L_HDR + "|" +
-            _LS_L_DATA
-         )
+# One compiled pattern per line kind; `parse_ldms_ls()` picks the pattern by
+# its section state and the first characters of the line instead of running
+# the alternation of all of them against every line.
+_PRE_META_KV_RE = re.compile(_PRE_META_KV)
+_META_BEGIN_RE = re.compile(_META_BEGIN)
+_META_DASHES_RE = re.compile(_META_DASHES)
+_META_DATA_RE = re.compile(_META_DATA)
+_META_SUMMARY_RE = re.compile(_META_SUMMARY)
+_LS_L_HDR_RE = re.compile(_LS_L_HDR)
+
 def int0(s):
     return int(s, base=0)
+
+def _int0_list(x):
+    return list(map(int, x.split(','), repeat(0)))
+
+def _float_list(x):
+    return list(map(float, x.split(',')))
+
 _TYPE_FN = {
     "char": lambda x: str(x).strip("'"),
     "char[]": lambda x: str(x).strip('"'),
@@ -120,16 +128,16 @@ _TYPE_FN = {
     "f32": float,
     "d64": float,
 
-    "u8[]": lambda x: list(map(int0, x.split(','))),
-    "s8[]": lambda x: list(map(int0, x.split(','))),
-    "u16[]": lambda x: list(map(int0, x.split(','))),
-    "s16[]": lambda x: list(map(int0, x.split(','))),
-    "u32[]": lambda x: list(map(int0, x.split(','))),
-    "s32[]": lambda x: list(map(int0, x.split(','))),
-    "u64[]": lambda x: list(map(int0, x.split(','))),
-    "s64[]": lambda x: list(map(int0, x.split(','))),
-    "f32[]": lambda x: list(map(float, x.split(','))),
-    "d64[]": lambda x: list(map(float, x.split(','))),
+    "u8[]": _int0_list,
+    "s8[]": _int0_list,
+    "u16[]": _int0_list,
+    "s16[]": _int0_list,
+    "u32[]": _int0_list,
+    "s32[]": _int0_list,
+    "u64[]": _int0_list,
+    "s64[]": _int0_list,
+    "f32[]": _float_list,
+    "d64[]": _float_list,
 }
 
 def parse_ldms_ls(txt):
@@ -165,29 +173,46 @@ def parse_ldms_ls(txt):
     lines = txt.splitlines()
     D.txt = txt
     D.lines = lines
-    itr = iter(lines)
     section = 0 # 0-pre_meta, 1-meta, 2-data
-    for l in itr:
+    data = None
+    data_type = None
+    type_fn = _TYPE_FN
+    for l in lines:
         l = l.strip()
         if not l: # empty line, end of set
-            lset = None
             data = None
-            meta = None
-            continue
-        m = _LS_RE.match(l)
-        if not m:
-            D.l = l
-            raise RuntimeError("Bad line format: {}".format(l))
-        m = m.groupdict()
-        if m["meta_begin"]: # start meta section
-            if section != 0:
-                raise RuntimeError("Unexpected meta info: {}".format(l))
-            section = 1
+            data_type = None
             continue
-        elif m["meta_schema"]: # meta data
-            if section != 1:
+        if section == 2 and l[1:2] == " ":
+            # metric line "F TYPE NAME VALUE [UNIT]", the bulk of the output
+            try:
+                _f, mtype, mname, _val = l.split(None, 3)
+                fn = type_fn[mtype]
+            except (ValueError, KeyError):
+                pass # not a metric line, try the set header below
+            else:
+                if data is None:
+                    raise RuntimeError("Unexpected data info: {}".format(l))
+                if mtype != "char[]":
+                    _val = _val.split(' ', 1)[0] # remove units
+                data[mname] = fn(_val)
+                data_type[mname] = mtype
+                continue
+        elif section == 1:
+            c = l[0]
+            if c == "=" and l.count("=") == len(l): # end meta section
+                section = 2
+                continue
+            if c == "-" and _META_DASHES_RE.match(l): # dashes
+                continue
+            if c == "T" and _META_SUMMARY_RE.match(l): # the summary line
+                continue
+            m = _META_DATA_RE.match(l)
+            if not m:
+                D.l = l
                 raise RuntimeError("Unexpected meta info: {}".format(l))
-            meta = dict( schema_digest = m.get("meta_schema_digest", ""),
+            m = m.groupdict()
+            meta = dict( schema_digest = m["meta_schema_digest"],
                          schema = m["meta_schema"],
                          instance = m["meta_inst"],
                          flags = m["meta_flags"],
@@ -204,82 +229,73 @@ def parse_ldms_ls(txt):
             _set = ret.setdefault(m["meta_inst"], dict())
             _set["meta"] = meta
             _set["name"] = m["meta_inst"]
-        elif m["meta_total_sets"]: # the summary line
-            if section != 1:
-                raise RuntimeError("Unexpected meta info: {}".format(l))
-            # else do nothing
-            continue
-        elif m["meta_dashes"]: # dashes
-            if section != 1:
-                raise RuntimeError("Unexpected meta info: {}".format(l))
-            continue
-        elif m["meta_end"]: # end meta section
-            if section != 1:
-                raise RuntimeError("Unexpected meta info: {}".format(l))
-            section = 2
             continue
-        elif m["set_name"]: # new set
-            if section == 0: # we go straight into data (i.e. no -v or -vv)
-                section = 2
-            if section != 2:
-                raise RuntimeError("Unexpected data info: {}".format(l))
-            data = dict() # placeholder for metric data
-            data_type = dict() # placeholder for metric data type
-            lset = ret.setdefault(m["set_name"], dict())
-            lset["name"] = m["set_name"]
-            lset["ts"] = m["ts"]
-            lset["data"] = data
-            lset["data_type"] = data_type
-        elif m["metric_name"]: # data
-            if section != 2:
-                raise RuntimeError("Unexpected data info: {}".format(l))
-            if m["type"] == "char[]":
-                _val = m["metric_value"]
-            else:
-                _val = m["metric_value"].split(' ', 1)[0] # remove units
-            mname = m["metric_name"]
-            mtype = m["type"]
-            data[mname] = _TYPE_FN[mtype](_val)
-            data_type[mname] = mtype
-        elif m["pre_meta_key"]: # pre-meta (host name stuff)
-            if section != 0:
-                raise RuntimeError("Unexpected pre-meta info: {}".format(l))
-            continue # ignore
-        else:
-            raise RuntimeError("Unable to process line: {}".format(l))
+        elif section == 0:
+            if _PRE_META_KV_RE.match(l): # pre-meta (host name stuff)
+                continue # ignore
+            if _META_BEGIN_RE.match(l): # start meta section
+                section = 1
+                continue
+        # new set
+        m = _LS_L_HDR_RE.match(l)
+        if not m:
+            D.l = l
+            raise RuntimeError("Bad line format: {}".format(l))
+        section = 2 # from section 0 we go straight into data (no -v or -vv)
+        data = dict() # placeholder for metric data
+        data_type = dict() # placeholder for metric data type
+        set_name = m.group("set_name")
+        lset = ret.setdefault(set_name, dict())
+        lset["name"] = set_name
+        lset["ts"] = m.group("ts")
+        lset["data"] = data
+        lset["data_type"] = data_type
     return ret
 
-def create_suite_from_C_test_results(txt, tada_addr):
-    import json
-
-    r = json.loads(txt)
-    cnt = len(r)
-
-    test = TADA.Test(test_suite = r[0]["test-suite"],
-                     test_type = r[0]["test-type"],
-                     test_name = r[0]["test-name"],
-                     test_desc = r[0]["test-desc"],
-                     test_user = r[0]["test-user"],
-                     commit_id = r[0]["commit-id"],
-                     tada_addr = tada_addr)
-
-    for msg in r:
-        if msg["msg-type"] == "assert-status":
-            test.add_assertion(msg["assert-no"], msg["assert-desc"])
-
-    test.start()
-
-    try:
-        for msg in r:
-            if msg["msg-type"] == "assert-status":
-                result = True if (msg["test-status"] == "passed") else False
-                test.assert_test(msg["assert-no"], result, msg["assert-cond"])
-    except:
-        test.finish()
-        raise
-
-    test.finish()
-    return test.exit_code()
+def create_suite_from_C_test_results(txt, tada_addr, transport = "udp"):
+    """Upload the results document written by a C test program (`tada.c`)
+
+    The whole document is sent to `tadad` at `tada_addr` at once (see
+    `TADA.upload_results()`). `transport` is "udp" (always served by
+    `tadad`), or "tcp" for `tadad` started with `--tcp-port` on the port of
+    `tada_addr`, to write the document in a single transaction. If the
+    document cannot be sent over the stream connection (e.g. `tadad` not
+    responding), it is sent over udp instead. The upload errors are logged,
+    not raised, like the udp reporting of `TADA.Test`. In spool mode
+    (`TADA.SPOOL_DIR`), the document is saved in the spool directory for
+    `tadaq import`.
+
+    Returns 0 if all assertions passed, or -1 otherwise (see
+    `TADA.results_exit_code()`, e.g. the test crashed).
+    """
+    msgs = TADA.parse_results(txt)
+    if TADA.SPOOL_DIR:
+        test_id = msgs[0].get("test-id") if msgs else None
+        if not test_id:
+            raise ValueError("Cannot spool a results document without "
+                             "`test-id`")
+        os.makedirs(TADA.SPOOL_DIR, exist_ok = True)
+        path = os.path.join(TADA.SPOOL_DIR, "{}.json".format(test_id))
+        with open(path, "w") as f:
+            json.dump(msgs, f)
+    else:
+        try:
+            TADA.upload_results(txt, tada_addr, transport)
+        except OSError as e:
+            err = e
+            if transport != "udp":
+                logger.warning("Cannot upload the results to tadad at {} "
+                               "over {} ({}), uploading over udp" \
+                               .format(tada_addr, transport, e))
+                try:
+                    TADA.upload_results(txt, tada_addr, "udp")
+                    err = None
+                except OSError as e:
+                    err = e
+            if err:
+                logger.error("Cannot upload the results to tadad at {}: {}" \
+                             .format(tada_addr, err))
+    return TADA.results_exit_code(msgs)
 
 def env_dict(env):
     """Make env dict(NAME:VALUE) from list(NAME=VALUE) or dict(NAME:VALUE)
@@ -372,6 +388,10 @@ def add_common_args(parser):
             default="tada-host:9862")
     parser.add_argument("--debug", default=0, type=int,
             help="Turn on TADA.DEBUG flag.")
+    parser.add_argument("--tada_spool", "--tada-spool", default=0, type=int,
+            help="If non-zero, append the test results to journals in "
+                 "DATA_ROOT/tada_spool instead of sending them to tadad. "
+                 "The journals can be imported with `tadaq import`.")
     parser.add_argument("--mount", action="append",
             metavar = "SRC:DST[:MODE]", default = [],
             help="Add additional mount point to the container. "
@@ -399,6 +419,7 @@ def process_config_file(path = None):
                 "data_root": None,
                 "tada_addr": "tada-host:9862",
                 "debug": 0,
+                "tada_spool": 0,
                 "mount": "",
                 "image": "ovis-centos-build",
                 "atstart": None,
@@ -452,6 +473,8 @@ def process_args(parsed_args):
     m.process_config(G.conf)
     if args.debug:
         TADA.DEBUG = True
+    if args.tada_spool:
+        TADA.SPOOL_DIR = os.path.join(args.data_root, "tada_spool")
 
 DEEP_COPY_TBL = {
         dict: lambda x: { k:deep_copy(v) for k,v in x.items() },
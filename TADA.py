@@ -4,9 +4,15 @@ import sys
 import pwd
 import time
 import json
+import gzip
+import atexit
+import struct
 import socket
 import hashlib
 import binascii
+import itertools
+import statistics
+import threading
 import subprocess
 import warnings
 
@@ -15,6 +21,8 @@ import importlib
 import logging
 
 from io import StringIO
+from contextlib import contextmanager
+from collections import OrderedDict
 
 log = logging.getLogger(__name__)
 
@@ -23,6 +31,7 @@ warnings.filterwarnings('ignore') # to suppress mysql bogus warnings
 
 LOGIN = pwd.getpwuid(os.geteuid())[0]
 DEBUG = False
+SPOOL_DIR = None # the default `spool_dir` of `Test`
 
 TERM_RESET  = '\033[0m'
 TERM_BOLD   = '\033[1m'
@@ -35,6 +44,185 @@ TERM_TEAL   = '\033[36m'
 
 class AssertionException(Exception): pass
 
+# A batch message packs multiple messages into a single datagram:
+#   { "msg-type": "batch", "msgs": [ MSG0, MSG1, ... ] }
+BATCH_HEAD = b'{"msg-type": "batch", "msgs": ['
+BATCH_TAIL = b']}'
+BATCH_OVERHEAD = len(BATCH_HEAD) + len(BATCH_TAIL)
+
+# Stream transports (tcp, unix) send messages in frames, each of which is a
+# 4-byte message length in network byte order followed by the message.
+FRAME_HDR = struct.Struct("!I")
+MAX_FRAME = 64*1024*1024
+
+def frame(data):
+    """Returns `data` (bytes) prefixed with the frame header"""
+    return FRAME_HDR.pack(len(data)) + data
+
+def batch_msgs(msg):
+    """Returns the list of messages packed in `msg`
+
+    `msg` could be a single message (dict) or a "batch" message. ValueError
+    is raised if `msg` is neither of them. The elements of a batch are not
+    checked, the caller has to skip the ones that are not a message (dict).
+    """
+    if type(msg) != dict:
+        raise ValueError("not a message")
+    if msg.get("msg-type") == "batch":
+        msgs = msg.get("msgs", [])
+        if type(msgs) != list:
+            raise ValueError("batch message without a list of messages")
+        return msgs
+    return [ msg ]
+
+def _text(v):
+    if type(v) not in (str, int, float):
+        raise TypeError("not a text")
+    return v
+
+# The fields of the messages written to the database (see TADA_DB.ingest()):
+#   msg-type => [ (field, conversion, required), ... ]
+MSG_FIELDS = {
+    "test-start": [ ("test-suite", _text, True), ("test-type", _text, True),
+                    ("test-name", _text, True), ("commit-id", _text, True),
+                    ("timestamp", int, True), ("test-user", _text, False),
+                    ("test-desc", _text, False) ],
+    "assert-status": [ ("assert-no", _text, True),
+                       ("test-status", _text, True),
+                       ("assert-cond", _text, True),
+                       ("assert-desc", _text, True),
+                       ("timestamp", float, False) ],
+    "phase-begin": [ ("phase-no", int, True), ("phase-name", _text, True),
+                     ("timestamp", float, True),
+                     ("phase-parent", int, False) ],
+    "phase-end": [ ("phase-no", int, True), ("timestamp", float, True),
+                   ("phase-status", _text, False) ],
+    "metric": [ ("metric-no", int, True), ("metric-name", _text, True),
+                ("metric-value", float, True), ("metric-unit", _text, False),
+                ("timestamp", float, False) ],
+    "test-finish": [ ("timestamp", int, True) ],
+}
+
+def check_msg(msg):
+    """Returns the reason why `msg` cannot be processed, or None if it is OK
+
+    The messages are checked before they are written with `TADA_DB.ingest()`
+    (e.g. queued by `tadad`, or imported from a journal), so that a malformed
+    message does not fail the whole transaction.
+    """
+    test_id = msg.get("test-id")
+    if not test_id or type(test_id) != str:
+        return "`test-id` is not a string"
+    seq = msg.get("seq")
+    if seq is not None and type(seq) != int:
+        return "`seq` is not an integer"
+    msg_type = msg.get("msg-type")
+    if type(msg_type) != str:
+        return "`msg-type` is not a string"
+    for name, conv, required in MSG_FIELDS.get(msg_type, ()):
+        v = msg.get(name)
+        if v is None:
+            if required:
+                return "missing `{}`".format(name)
+            continue
+        try:
+            conv(v)
+        except (TypeError, ValueError, OverflowError):
+            return "bad `{}`: {!r:.40}".format(name, v)
+    return None
+
+def parse_results(data):
+    """Returns the list of messages in a results document
+
+    The results document is the JSON array of the messages of a test, as
+    written by the C `tada.c` log (text, bytes or the decoded list). A
+    document cut short by a crashed test (without the closing bracket) is
+    accepted, and the test without "test-finish" is marked incomplete with a
+    "test-incomplete" message.
+    """
+    if type(data) == list: # already decoded
+        msgs = data
+    else:
+        if type(data) == bytes:
+            data = data.decode()
+        try:
+            msgs = json.loads(data)
+        except ValueError:
+            msgs = json.loads(data.rstrip().rstrip(",") + "]")
+    if type(msgs) != list or not all( type(m) == dict for m in msgs ):
+        raise ValueError("not a results document")
+    if msgs and not any( m.get("msg-type") == "test-finish" for m in msgs ):
+        msgs.append({ "msg-type": "test-incomplete",
+                      "test-id": msgs[0].get("test-id") })
+    return msgs
+
+def results_exit_code(msgs):
+    """The exit code of the test in a results document, like
+    `Test.exit_code()`: 0 if all assertions passed, -1 otherwise
+
+    The test that did not start ("test-start" missing, e.g. an empty
+    document), did not finish ("test-incomplete") or has no assertions
+    failed too.
+    """
+    types = set( m.get("msg-type") for m in msgs )
+    if "test-start" not in types or "test-incomplete" in types:
+        return -1
+    status = { m["assert-no"]: m["test-status"] for m in msgs \
+               if m.get("msg-type") == "assert-status" }
+    if not status:
+        return -1
+    return 0 if all( s == Test.PASSED for s in status.values() ) else -1
+
+def upload_results(data, tada_addr = "localhost:9862", transport = "tcp",
+                   timeout = 10.0):
+    """Send a results document (see `parse_results()`) to `tadad` at once
+
+    With "tcp" (`tada_addr` is HOST:PORT) or "unix" (`tada_addr` is the
+    socket path) transport, the document is sent in a single frame, and
+    `tadad` writes it to the database in a single transaction. With "udp",
+    the document is sent in a single datagram if it fits in
+    `Test.MAX_DATAGRAM`, otherwise its messages are sent in batch datagrams.
+    The stream connection and the sending time out after `timeout` seconds
+    (`socket.timeout`, an OSError).
+    """
+    if type(data) == str:
+        data = data.encode()
+    if transport == "unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(tada_addr)
+            sock.sendall(frame(data))
+        finally:
+            sock.close()
+        return
+    host, _, port = tada_addr.partition(":")
+    port = int(port) if port else 9862
+    if transport == "tcp":
+        with socket.create_connection((host, port), timeout) as sock:
+            sock.sendall(frame(data))
+        return
+    if transport != "udp":
+        raise ValueError("Unsupported transport: {}".format(transport))
+    family, _type, proto, cname, addr = socket.getaddrinfo(host, port,
+                                        socket.AF_UNSPEC, socket.SOCK_DGRAM)[0]
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        if len(data) <= Test.MAX_DATAGRAM:
+            sock.sendto(data, addr)
+            return
+        buf = list()
+        sz = BATCH_OVERHEAD
+        for msg in parse_results(data):
+            msg = json.dumps(msg).encode()
+            if buf and sz + len(msg) + 1 > Test.MAX_DATAGRAM:
+                sock.sendto(BATCH_HEAD + b",".join(buf) + BATCH_TAIL, addr)
+                buf = list()
+                sz = BATCH_OVERHEAD
+            buf.append(msg)
+            sz += len(msg) + 1
+        if buf:
+            sock.sendto(BATCH_HEAD + b",".join(buf) + BATCH_TAIL, addr)
+
 class Test(object):
     """TADA Test Utility
 
@@ -44,11 +232,24 @@ class Test(object):
       - test_type : str
       - test_name : str
     And, optionally specify:
-      - tada_addr : "ADDR:PORT" - for `tadad` connection
+      - tada_addr : "ADDR:PORT" - for `tadad` connection, or the path to
+        `tadad` unix socket if `transport` is "unix".
+      - transport : "udp", "tcp" or "unix" - the transport to `tadad`
+        (default: "udp"). The "tcp" and "unix" transports send the messages
+        in frames over a stream connection, and re-send the messages of the
+        test when the connection is re-established.
       - test_user : str - to specify `user` running the test
         (default `{LOGIN}`)
       - commit_id : str - to specify the commit_id of the target program in
         testing.
+      - spool_dir : str - to append the messages to a journal file
+        `{spool_dir}/{test_id}.jsonl` (one JSON message per line) instead of
+        sending them to `tadad` (default: `TADA.SPOOL_DIR`). The journals are
+        imported into the database later with `tadaq import`.
+      - buffered : bool - to pack the messages into as few datagrams as
+        possible instead of sending one datagram per message. The buffered
+        messages are sent when the datagram is full, when `flush_interval`
+        seconds elapsed, or when `finish()` is called (default: False).
 
     (test_suite, test_type, test_name, test_user, commit_id) combination is used
     to identify the test in `tadad` database. This means that re-running the
@@ -75,18 +276,28 @@ class Test(object):
     FAILED_COLOR  = TERM_BOLD + TERM_RED    + "failed"  + TERM_RESET
     SKIPPED_COLOR = TERM_BOLD + TERM_YELLOW + "skipped" + TERM_RESET
 
+    MAX_DATAGRAM = 32*1024 # max size of a buffered datagram
+    SEND_RETRY = 5 # number of (re)connect attempts for stream transports
+
     def __init__(self, test_suite, test_type, test_name, test_desc = None,
                  tada_addr="localhost:9862", test_user=LOGIN,
-                 commit_id="-"):
+                 commit_id="-", buffered=False, flush_interval=1.0,
+                 transport="udp", spool_dir=None):
         self.test_suite = test_suite
         self.test_type = test_type
         self.test_name = test_name
         self.test_user = test_user
         self.commit_id = commit_id
         self.test_desc = test_desc if test_desc else test_name
+        if transport not in ("udp", "tcp", "unix"):
+            raise ValueError("Unsupported transport: {}".format(transport))
+        self.transport = transport
         if tada_addr is None:
             self.tada_host = "localhost"
             self.tada_port = 9862
+        elif transport == "unix":
+            self.tada_host = tada_addr
+            self.tada_port = None
         else:
             s = tada_addr.split(':')
             self.tada_host = s[0]
@@ -95,7 +306,75 @@ class Test(object):
             else:
                 self.tada_port = 9862
         self.assertions = dict()
-        self.sock_fd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.spool_dir = spool_dir if spool_dir is not None else SPOOL_DIR
+        self._journal = None
+        # resolve `tadad` address only once
+        if self.spool_dir:
+            self.tada_family = self.tada_sockaddr = None # no network
+        elif transport == "unix":
+            self.tada_family = socket.AF_UNIX
+            self.tada_sockaddr = self.tada_host
+        else:
+            _type = socket.SOCK_DGRAM if transport == "udp" \
+                                      else socket.SOCK_STREAM
+            ai = socket.getaddrinfo(self.tada_host, self.tada_port,
+                                    socket.AF_UNSPEC, _type)
+            self.tada_family, _type, proto, cname, self.tada_sockaddr = ai[0]
+        if transport == "udp" and not self.spool_dir:
+            self.sock_fd = socket.socket(self.tada_family, socket.SOCK_DGRAM)
+        else:
+            self.sock_fd = None # connected on demand
+        self._seq = 0
+        self._history = list() # sent data, re-sent on stream reconnect
+        self._wall0 = self._mono0 = None # the timestamp anchors
+        self._phase_no = 0
+        self._phases = list() # the stack of the current phase numbers
+        self.buffered = buffered
+        self.flush_interval = flush_interval
+        self._buf = list() # encoded messages waiting to be sent
+        self._buf_sz = 0
+        self._buf_lock = threading.Lock()
+        self._timer = None
+
+    def _connect(self):
+        sock = socket.socket(self.tada_family, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.tada_sockaddr)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def _close(self):
+        if self.sock_fd:
+            self.sock_fd.close()
+            self.sock_fd = None
+
+    def _stream_send(self, data):
+        # self._buf_lock is held
+        self._history.append(data)
+        for i in range(self.SEND_RETRY):
+            try:
+                if self.sock_fd is None:
+                    self.sock_fd = self._connect()
+                    # (re)send everything; `tadad` ignores duplicates by "seq"
+                    pending = self._history
+                else:
+                    pending = [ data ]
+                self.sock_fd.sendall(b"".join(map(frame, pending)))
+                return
+            except OSError as e:
+                log.warning("tadad {} connection error: {}" \
+                            .format(self.transport, e))
+                self._close()
+                time.sleep(0.1 * 2**i)
+        log.error("Cannot send messages to tadad at {}".format(self.tada_sockaddr))
+
+    def _sendto(self, data):
+        if self.transport == "udp":
+            self.sock_fd.sendto(data, self.tada_sockaddr)
+        else:
+            self._stream_send(data)
 
     def _send(self, msg):
         msg["test-id"] = self.test_id
@@ -104,13 +383,78 @@ class Test(object):
         elif type(msg) == str:
             msg = msg.encode()
         else:
+            msg["seq"] = self._seq
+            self._seq += 1
             msg = json.dumps(msg).encode()
-        self.sock_fd.sendto(msg, (self.tada_host, self.tada_port))
+        if self._journal:
+            self._journal.write(msg + b"\n")
+            self._journal.flush()
+            return
+        if not self.buffered:
+            with self._buf_lock:
+                self._sendto(msg)
+            return
+        with self._buf_lock:
+            if self._buf and \
+                    self._buf_sz + len(msg) + BATCH_OVERHEAD > self.MAX_DATAGRAM:
+                self._flush()
+            self._buf.append(msg)
+            self._buf_sz += len(msg) + 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        # self._buf_lock is held
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buf:
+            return
+        if len(self._buf) == 1:
+            data = self._buf[0]
+        else:
+            data = BATCH_HEAD + b",".join(self._buf) + BATCH_TAIL
+        self._buf = list()
+        self._buf_sz = 0
+        self._sendto(data)
+
+    def flush(self):
+        """Send the buffered messages to `tadad`"""
+        with self._buf_lock:
+            self._flush()
+
+    def _now(self):
+        """Sub-second timestamp of an event in the test
+
+        The timestamp is the wall clock at `start()` plus the monotonic clock
+        elapsed since then, so that the events are ordered even if the wall
+        clock is adjusted during the test.
+        """
+        if self._mono0 is None:
+            return time.time()
+        return self._wall0 + (time.monotonic() - self._mono0)
 
     def start(self):
+        self._wall0 = time.time()
+        self._mono0 = time.monotonic()
         s = "{t.test_suite}:{t.test_type}:{t.test_name}:{t.test_user}:" \
-            "{t.commit_id}:{ts}".format(t = self, ts = int(time.time()))
+            "{t.commit_id}:{ts}".format(t = self, ts = int(self._wall0))
         self.test_id = binascii.hexlify(hashlib.sha256(s.encode()).digest()).decode()
+        self._seq = 0
+        self._metric_no = 0
+        self._phase_no = 0
+        self._phases = list()
+        self._history = list()
+        if self.buffered:
+            # the messages still buffered at exit are sent; unregistered in
+            # finish() so that the finished Test is not kept alive
+            atexit.register(self.flush)
+        if self.spool_dir:
+            os.makedirs(self.spool_dir, exist_ok = True)
+            path = os.path.join(self.spool_dir, self.test_id + ".jsonl")
+            self._journal = open(path, "ab")
         log.info("starting test `{}`".format(self.test_name))
         log.info("  test-id: {}".format(self.test_id))
         log.info("  test-suite: {}".format(self.test_suite))
@@ -124,7 +468,7 @@ class Test(object):
                 "test-name": self.test_name,
                 "test-user": self.test_user,
                 "commit-id": self.commit_id,
-                "timestamp": time.time(),
+                "timestamp": self._wall0,
                 "test-id": self.test_id,
                 "test-desc": self.test_desc,
               }
@@ -149,6 +493,7 @@ class Test(object):
             msg["test-status"] = Test.FAILED
             status = Test.FAILED_COLOR if sys.stdout.isatty() else Test.FAILED
         msg["test-status"] = Test.PASSED if cond else Test.FAILED
+        msg["timestamp"] = self._now()
         self._send(msg)
         log.info("assertion {}, {}: {}, {}" \
                  .format(msg["assert-no"], msg["assert-desc"],
@@ -156,6 +501,68 @@ class Test(object):
         if not cond and DEBUG:
             raise AssertionException(self.test_desc + ", " + cond_str + ": FAILED")
 
+    def record_metric(self, name, value, unit=None, tags=None):
+        """Record a numeric measurement (e.g. a rate or a latency)
+
+        `value` is a number, `unit` is an optional unit string (e.g. "ops/s"),
+        and `tags` is an optional dictionary of JSON-serializable attributes
+        further describing the measurement (e.g. {"xprt": "sock"}). A test may
+        record the same metric `name` many times.
+
+        Example:
+        >>> test.record_metric("update_rate", 1234.5, "sets/s", {"xprt": "sock"})
+        """
+        msg = {
+                "msg-type": "metric",
+                "metric-no": self._metric_no,
+                "metric-name": name,
+                "metric-value": float(value),
+                "metric-unit": unit,
+                "metric-tags": tags,
+                "timestamp": self._now(),
+              }
+        self._metric_no += 1
+        self._send(msg)
+        log.info("metric {}: {} {}".format(name, value, unit if unit else ""))
+
+    @contextmanager
+    def phase(self, name):
+        """Mark a phase of the test (e.g. cluster bring-up) for timing
+
+        This sends "phase-begin" event on entering and "phase-end" event on
+        exiting the context. The phases can be nested. The phase ended by an
+        exception is recorded with "error" status. Example:
+        >>> with test.phase("start daemons"):
+        ...     cluster.start_daemons()
+        """
+        phase_no = self._phase_no
+        self._phase_no += 1
+        parent = self._phases[-1] if self._phases else None
+        self._phases.append(phase_no)
+        self._send({
+                "msg-type": "phase-begin",
+                "phase-no": phase_no,
+                "phase-name": name,
+                "phase-parent": parent,
+                "timestamp": self._now(),
+            })
+        log.info("phase `{}` begins".format(name))
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self._phases.pop()
+            self._send({
+                    "msg-type": "phase-end",
+                    "phase-no": phase_no,
+                    "phase-status": status,
+                    "timestamp": self._now(),
+                })
+            log.info("phase `{}` ends ({})".format(name, status))
+
     def finish(self):
         for num, msg in self.assertions.items():
             if msg["test-status"] == Test.SKIPPED:
@@ -166,9 +573,19 @@ class Test(object):
         msg = {
                 "msg-type": "test-finish",
                 "test-id": self.test_id,
-                "timestamp": time.time(),
+                "timestamp": self._now(),
               }
         self._send(msg)
+        self.flush()
+        if self.buffered:
+            atexit.unregister(self.flush)
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+        elif self.transport != "udp":
+            with self._buf_lock:
+                self._close()
+                self._history = list()
         log.info("test {} ended".format(self.test_name))
         return self.exit_code()
 
@@ -185,7 +602,9 @@ class SQLModel(object):
     Models subclassing this class (e.g. TADATestModel) must define `__table__`
     attribute for table name, `__cols__` attribute for a list of
     (COL_NAME,COL_TYPE) and `__ids__` attribute for a list of columns comprising
-    primary key.
+    primary key. The `__indexes__` attribute optionally lists the secondary
+    indexes as (INDEX_NAME, [COLUMNS]), which are created by
+    `TADA_DB.init_tables()`.
 
     For a `Model` subclassing this class, the application should:
     - `Model.create()` to insert a new object into the table
@@ -210,15 +629,27 @@ class SQLModel(object):
     __cols__ = [ ("COLUMN_NAMES", "COL_TYPE") ] # list of (NAME, TYPE) defining
                                                 # table columns
     __ids__ = [ "COLUMNS_IDENTIFYING_OBJECT" ] # columns comprising primary key
+    __indexes__ = [] # list of (INDEX_NAME, [ COLUMNS ]) secondary indexes
+
+    ITER_BATCH = 1000 # the number of rows fetched at a time by `iter()`
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # the column metadata shared by all objects of the class
+        cls.__colnames__, cls.__coltypes__ = zip(*cls.__cols__)
+        cls.__ids_idx__ = tuple( cls.__colnames__.index(k) \
+                                                    for k in cls.__ids__ )
 
     def __init__(self, conn, data):
         """App should use `get`, `find` or `create` and not call this direcly"""
         self._conn = conn
-        self.__colnames__, self.__coltypes__ = zip(*self.__cols__)
         # taking care of object ID first
         self._obj_id = self.__id_from_data(data)
         self._on_data_update(data)
-        self._qparam = conn_qparam(conn)
+
+    @property
+    def _qparam(self):
+        return conn_qparam(self._conn)
 
     def __iter__(self):
         for k in self.__colnames__:
@@ -238,6 +669,17 @@ class SQLModel(object):
         end = ")"
         return begin + body + pk + end
 
+    @classmethod
+    def _sql_index_statements(cls, dialect):
+        """Yields (INDEX_NAME, CREATE_INDEX_SQL) of the declared indexes"""
+        types = dict(cls.__cols__)
+        for name, cols in cls.__indexes__:
+            if dialect == "mysql": # mysql indexes only a prefix of TEXT
+                cols = [ "{}({})".format(c, MYSQL_TEXT_PREFIX) \
+                            if types[c] == "TEXT" else c for c in cols ]
+            yield name, "CREATE INDEX {} ON {} ({})" \
+                        .format(name, cls.__table__, ",".join(cols))
+
     @classmethod
     def get(cls, _conn, **kwargs):
         """Find exactly 1 object or create with given parameters if not found
@@ -270,6 +712,51 @@ class SQLModel(object):
         lst = cur.fetchall()
         return [ cls(_conn, data) for data in lst ]
 
+    @classmethod
+    def iter(cls, _conn, order_by=None, batch_size=None, **kwargs):
+        """Iterate over the objects matching the conditions
+
+        Unlike `find()`, the rows are fetched `batch_size` (default:
+        `ITER_BATCH`) rows at a time and the objects are created as they are
+        iterated, so that the memory usage does not grow with the number of
+        matching rows. On pgsql, the rows are read through a server-side
+        cursor, which is closed if the transaction ends before the iteration
+        does.
+
+        Example:
+        >>> for obj in TADATestModel.iter(conn, order_by = "test_start",
+        ...                               test_user = "bob"):
+        ...     print(obj.test_name)
+        """
+        qparam = conn_qparam(_conn)
+        cond = " and ".join( "{}={}".format(k, qparam) for k in kwargs.keys() )
+        sql = "SELECT * FROM {}".format(cls.__table__)
+        if cond:
+            sql += " WHERE {}".format(cond)
+        if order_by:
+            sql += " ORDER BY {}".format(order_by)
+        return cls.iter_sql(_conn, sql, tuple(map(str, kwargs.values())),
+                            batch_size = batch_size)
+
+    @classmethod
+    def iter_sql(cls, _conn, sql, params=(), batch_size=None):
+        """Like `iter()`, but with the given SELECT statement and parameters
+
+        The statement must select all table columns in the table order (e.g.
+        `SELECT t.* FROM ...`).
+        """
+        cur = conn_stream_cursor(_conn)
+        try:
+            cur.execute(sql, params)
+            while True:
+                lst = cur.fetchmany(batch_size or cls.ITER_BATCH)
+                if not lst:
+                    break
+                for data in lst:
+                    yield cls(_conn, data)
+        finally:
+            cur.close()
+
     @classmethod
     def find_first(cls, _conn, order_by=None, **kwargs):
         _order_by =  "ORDER BY {}".format(order_by) if order_by else ""
@@ -296,8 +783,8 @@ class SQLModel(object):
         >>> x = TADATestModel.create(conn, "abc", "bla", ...)
 
         In the first two forms, the unspecified fields will be blank. In the
-        latter two forms all fields must be specified in the same order as table
-        colums.
+        latter two forms the fields must be specified in the same order as table
+        colums, and the unspecified trailing fields will be blank.
         """
         # infer obj from *args and **kwargs
         if args:
@@ -322,9 +809,12 @@ class SQLModel(object):
         elif obj_type in [ list, tuple ]:
             vals = obj
             _id = cls.__id_from_data(obj)
-            sql = "INSERT INTO {} VALUES ({})" \
+            # the trailing columns not in `obj` are left blank
+            cols = [ n for n, t in cls.__cols__[:len(vals)] ]
+            sql = "INSERT INTO {} ({}) VALUES ({})" \
                 .format(
                     cls.__table__,
+                    ",".join( cols ),
                     ",".join( [qparam] * len(vals) )
                 )
         cur = _conn.cursor()
@@ -333,6 +823,71 @@ class SQLModel(object):
         _conn.commit()
         return cls.get(_conn, **_id)
 
+    @classmethod
+    def _rows_by_cols(cls, rows):
+        # group the rows (dict, or sequence in table column order) by their
+        # column sets for `executemany()`
+        colnames = tuple( n for n, t in cls.__cols__ )
+        groups = dict()
+        for row in rows:
+            if isinstance(row, dict):
+                cols, vals = tuple(row.keys()), tuple(row.values())
+            else:
+                vals = tuple(row)
+                cols = colnames[:len(vals)]
+            groups.setdefault(cols, list()).append(vals)
+        return groups
+
+    @classmethod
+    def bulk_upsert(cls, _conn, rows, commit = True):
+        """Insert the rows, or update them if they exist, in one transaction
+
+        `rows` is an iterable of dicts ({COL_NAME: VALUE}) or sequences of
+        values in the same order as table columns (the unspecified trailing
+        columns are left blank). The rows must include the primary key
+        columns. The existing rows are updated only in the given columns.
+        Unlike `create()`, the rows are not read back. If `commit` is False,
+        the caller is responsible for committing the transaction.
+
+        Example:
+        >>> TADAAssertionModel.bulk_upsert(conn, [
+        ...     {"test_id": "abc", "assert_id": "1", "assert_result": "passed"},
+        ...     {"test_id": "abc", "assert_id": "2", "assert_result": "failed"},
+        ... ])
+        """
+        cur = _conn.cursor()
+        for cols, params in cls._rows_by_cols(rows).items():
+            sql = sql_upsert(_conn, cls.__table__, cols, cls.__ids__)
+            conn_executemany(_conn, cur, sql, params)
+        if commit:
+            _conn.commit()
+
+    @classmethod
+    def bulk_update(cls, _conn, rows, commit = True):
+        """Update the existing rows by their primary keys in one transaction
+
+        `rows` is an iterable of model objects (all columns are written), or
+        dicts/sequences as in `bulk_upsert()` (only the given columns are
+        written). The rows not in the table are ignored. If `commit` is False,
+        the caller is responsible for committing the transaction.
+        """
+        qparam = conn_qparam(_conn)
+        rows = [ r.as_dict() if isinstance(r, SQLModel) else r for r in rows ]
+        cur = _conn.cursor()
+        for cols, params in cls._rows_by_cols(rows).items():
+            upd = [ c for c in cols if c not in cls.__ids__ ]
+            if not upd:
+                continue
+            idx = [ cols.index(c) for c in upd + cls.__ids__ ]
+            sql = "UPDATE {} SET {} WHERE {}".format(cls.__table__,
+                    ",".join( "{}={}".format(c, qparam) for c in upd ),
+                    " and ".join( "{}={}".format(c, qparam) \
+                                                    for c in cls.__ids__ ))
+            conn_executemany(_conn, cur, sql,
+                             [ tuple(p[i] for i in idx) for p in params ])
+        if commit:
+            _conn.commit()
+
     def __cmp__(self, other):
         for k in self.__colnames__:
             a0 = getattr(self, k)
@@ -371,10 +926,7 @@ class SQLModel(object):
     def __id_from_data(cls, data):
         if type(data) == dict:
             return { k: data[k] for k in cls.__ids__ }
-        colnames, coltypes = zip(*cls.__cols__)
-        idx = map(lambda x: colnames.index(x), cls.__ids__)
-        obj_id = { k: data[i] for k, i in zip(cls.__ids__, idx) }
-        return obj_id
+        return { k: data[i] for k, i in zip(cls.__ids__, cls.__ids_idx__) }
 
     def _on_data_update(self, data):
         # update self attr according to data (list)
@@ -445,6 +997,17 @@ class SQLModel(object):
         return getattr(self, key)
 
 
+class TADASchemaModel(SQLModel):
+    """The schema versions (migrations) applied to the database"""
+    __table__ = "TADASchema"
+    __cols__ = [
+              ( "version"     , "INTEGER" )  ,
+              ( "description" , "TEXT"    )  ,
+              ( "applied"     , "INTEGER" )  ,
+        ]
+    __ids__ = [ "version" ]
+
+
 class TADATestModel(SQLModel):
     __table__ = "TADATest"
     __cols__ = [
@@ -457,12 +1020,33 @@ class TADATestModel(SQLModel):
               ( "test_desc"   , "TEXT"        )  ,
               ( "test_start"  , "INTEGER"     )  ,
               ( "test_finish" , "INTEGER"     )  ,
+              ( "test_status" , "TEXT"        )  ,
         ]
     __ids__ = [ "test_id" ]
 
+    __indexes__ = [
+            ( "TADATest_run"    , [ "test_suite", "test_type", "test_name",
+                                    "test_user", "commit_id", "test_start" ] ),
+            ( "TADATest_name"   , [ "test_name", "test_start" ] ),
+            ( "TADATest_user"   , [ "test_user", "test_start" ] ),
+            ( "TADATest_commit" , [ "commit_id", "test_start" ] ),
+            ( "TADATest_start"  , [ "test_start" ] ),
+        ]
+
+    RUNNING = "running"
+    FINISHED = "finished"
+    INCOMPLETE = "incomplete" # abandoned before finishing
+
+    # the assertions and phases preloaded by `TADA_DB.iterTestsWithAssertions()`
+    _assertions = None
+    _phases = None
+    _metrics = None
+
     @property
     def assertions(self):
         """all assertions belong to this test"""
+        if self._assertions is not None:
+            return self._assertions
         sql = "SELECT * FROM {} WHERE test_id={}" \
               .format(TADAAssertionModel.__table__, self._qparam)
         cur = self._conn.cursor()
@@ -477,21 +1061,42 @@ class TADATestModel(SQLModel):
                     assert_id = assert_id
                 )
 
+    @property
+    def phases(self):
+        """all phases of this test, in the order they began"""
+        if self._phases is not None:
+            return self._phases
+        sql = "SELECT * FROM {} WHERE test_id={} ORDER BY phase_no" \
+              .format(TADAPhaseModel.__table__, self._qparam)
+        cur = self._conn.cursor()
+        cur.execute(sql, [str(self.test_id)])
+        return [ TADAPhaseModel(self._conn, d) for d in cur.fetchall() ]
+
+    @property
+    def metrics(self):
+        """all metrics recorded by this test"""
+        if self._metrics is not None:
+            return self._metrics
+        sql = "SELECT * FROM {} WHERE test_id={} ORDER BY metric_no" \
+              .format(TADAMetricModel.__table__, self._qparam)
+        cur = self._conn.cursor()
+        cur.execute(sql, [str(self.test_id)])
+        return [ TADAMetricModel(self._conn, d) for d in cur.fetchall() ]
+
     def delete(self):
-        """Delete the Test and the Assertions from the database"""
-        for a in self.assertions:
-            a.delete()
+        """Delete the Test and its Assertions, Phases and Metrics"""
+        cur = self._conn.cursor()
+        for m in TEST_CHILD_MODELS:
+            cur.execute("DELETE FROM {} WHERE test_id={}" \
+                        .format(m.__table__, self._qparam), [str(self.test_id)])
         super(TADATestModel, self).delete()
 
     def equivalent(self, other):
         """Check the equivalent (same everythin except test_id and ts)"""
         ATTRS = [ "test_suite", "test_type", "test_name",
                   "test_user", "commit_id" ]
-        for attr in ATTRS:
-            c = cmp(getattr(self, attr), getattr(other, attr))
-            if c:
-                return False
-        return True
+        return all( getattr(self, attr) == getattr(other, attr) \
+                    for attr in ATTRS )
 
 
 class TADAAssertionModel(SQLModel):
@@ -502,30 +1107,299 @@ class TADAAssertionModel(SQLModel):
              ( "assert_result" , "TEXT"        )  ,
              ( "assert_cond"   , "TEXT"        )  ,
              ( "assert_desc"   , "TEXT"        )  ,
+             ( "assert_ts"     , "DOUBLE PRECISION" )  ,
         ]
     __ids__ = [ "test_id", "assert_id" ]
 
+    @staticmethod
+    def sort_key(obj):
+        """The key to sort the assertions by numeric `assert_id`"""
+        return TADAAssertionModel.id_key(obj.assert_id)
+
+    @staticmethod
+    def id_key(assert_id):
+        """The sort key of an `assert_id`, numeric if possible"""
+        try:
+            return (0, float(assert_id), "")
+        except (TypeError, ValueError):
+            return (1, 0, str(assert_id))
+
+
+class TADAPhaseModel(SQLModel):
+    __table__ = "TADAPhase"
+    __cols__ = [
+             ( "test_id"      , "VARCHAR(64)"      )  ,
+             ( "phase_no"     , "INTEGER"          )  ,
+             ( "phase_name"   , "TEXT"             )  ,
+             ( "phase_parent" , "INTEGER"          )  , # phase_no or NULL
+             ( "phase_begin"  , "DOUBLE PRECISION" )  ,
+             ( "phase_end"    , "DOUBLE PRECISION" )  ,
+             ( "phase_status" , "TEXT"             )  ,
+        ]
+    __ids__ = [ "test_id", "phase_no" ]
+
+    @property
+    def duration(self):
+        """The phase duration in seconds, or None if the phase has not ended"""
+        if self.phase_begin is None or self.phase_end is None:
+            return None
+        return self.phase_end - self.phase_begin
+
+
+class TADAMetricModel(SQLModel):
+    __table__ = "TADAMetric"
+    __cols__ = [
+             ( "test_id"      , "VARCHAR(64)"      )  ,
+             ( "metric_no"    , "INTEGER"          )  ,
+             ( "metric_name"  , "TEXT"             )  ,
+             ( "metric_value" , "DOUBLE PRECISION" )  ,
+             ( "metric_unit"  , "TEXT"             )  ,
+             ( "metric_tags"  , "TEXT"             )  , # JSON object
+             ( "metric_ts"    , "DOUBLE PRECISION" )  ,
+        ]
+    __ids__ = [ "test_id", "metric_no" ]
+    __indexes__ = [
+            ( "TADAMetric_name" , [ "metric_name" ] ),
+        ]
+
+    @property
+    def tags(self):
+        """`metric_tags` decoded into a dictionary"""
+        return json.loads(self.metric_tags) if self.metric_tags else dict()
+
+
+class TADAAssertionStatModel(SQLModel):
+    """The rollup of the results of an assertion across the test runs
+
+    The rows are maintained by `TADA_DB.ingest()` as the test runs complete
+    (see `fold()`), so that the flakiness of the assertions can be reported
+    without reading the TADAAssertion history. The runs are folded in the
+    order of their start time, also when concurrent runs complete out of
+    order (see `refold()`). `last_results` holds the results of the
+    last `WINDOW` runs, oldest first, one character per run (see `CODES`). A
+    flip is a change between passed and failed, ignoring the skipped runs.
+    """
+    __table__ = "TADAAssertionStat"
+    __cols__ = [
+             ( "test_suite"   , "VARCHAR(255)" )  ,
+             ( "test_name"    , "VARCHAR(255)" )  ,
+             ( "assert_id"    , "VARCHAR(64)"  )  ,
+             ( "run_count"    , "INTEGER"      )  ,
+             ( "pass_count"   , "INTEGER"      )  ,
+             ( "fail_count"   , "INTEGER"      )  ,
+             ( "skip_count"   , "INTEGER"      )  ,
+             ( "flip_count"   , "INTEGER"      )  ,
+             ( "last_results" , "VARCHAR(64)"  )  ,
+             ( "last_flip"    , "INTEGER"      )  , # test_start of the flip
+             ( "last_test_id" , "VARCHAR(64)"  )  ,
+             ( "last_start"   , "INTEGER"      )  ,
+        ]
+    __ids__ = [ "test_suite", "test_name", "assert_id" ]
+
+    WINDOW = 64 # the number of results kept in `last_results`
+    CODES = { "passed": "P", "failed": "F", "skipped": "S" }
+    COUNTS = { "P": "pass_count", "F": "fail_count", "S": "skip_count" }
+
+    @staticmethod
+    def _last_pf(results):
+        # the last passed/failed code in `results`, or None
+        results = results.rstrip("S")
+        return results[-1] if results else None
+
+    @classmethod
+    def fold(cls, row, test_id, test_start, result):
+        """Fold the `result` of a test run into the rollup `row` (a dict)
+
+        The result of the same test run as the last one folded (e.g. the
+        test finished again) replaces the last result.
+        """
+        code = cls.CODES.get(result, "?")
+        results = row.get("last_results") or ""
+        if results and row.get("last_test_id") == test_id:
+            old, results = results[-1], results[:-1]
+            row["run_count"] -= 1
+            if old in cls.COUNTS:
+                row[cls.COUNTS[old]] -= 1
+            prev = cls._last_pf(results)
+            if old != "S" and prev and prev != old:
+                row["flip_count"] -= 1
+        for k in [ "run_count", "flip_count" ] + list(cls.COUNTS.values()):
+            row[k] = row.get(k) or 0
+        prev = cls._last_pf(results)
+        if code in "PF" and prev and prev != code:
+            row["flip_count"] += 1
+            row["last_flip"] = test_start
+        row["run_count"] += 1
+        if code in cls.COUNTS:
+            row[cls.COUNTS[code]] += 1
+        row["last_results"] = (results + code)[-cls.WINDOW:]
+        row["last_test_id"] = test_id
+        row["last_start"] = test_start
+        return row
+
+    @classmethod
+    def refold(cls, row, n, runs):
+        """Replace the last `n` results folded into `row` with `runs`
+
+        `runs` is the list of (test_start, test_id, result) in the order of
+        the start time. This folds a run that completes after the runs started
+        later than itself. Returns False if the `n` results are no longer all
+        in `last_results`, the rollup must then be rebuilt.
+        """
+        results = row.get("last_results") or ""
+        if n > len(results) or not runs:
+            return False
+        keep, old = results[:len(results)-n], results[len(results)-n:]
+        new = "".join( cls.CODES.get(r, "?") for s, t, r in runs )
+        def flips(codes):
+            prev, count = cls._last_pf(keep), 0
+            for code in codes.replace("S", ""):
+                count += code in "PF" and prev is not None and prev != code
+                prev = code
+            return count
+        for code in old:
+            if code in cls.COUNTS:
+                row[cls.COUNTS[code]] -= 1
+        for code in new:
+            if code in cls.COUNTS:
+                row[cls.COUNTS[code]] += 1
+        row["run_count"] += len(new) - n
+        row["flip_count"] += flips(new) - flips(old)
+        prev = cls._last_pf(keep)
+        for (start, test_id, result), code in zip(runs, new):
+            if code in "PF" and prev and prev != code:
+                row["last_flip"] = start
+            if code != "S":
+                prev = code
+        row["last_results"] = (keep + new)[-cls.WINDOW:]
+        row["last_start"], row["last_test_id"] = runs[-1][:2]
+        return True
+
+    def window_flips(self, window):
+        """The number of flips within the last `window` results"""
+        results = (self.last_results or "")[-window:].replace("S", "")
+        return sum( a != b for a, b in zip(results, results[1:]) )
+
+
+# the models of the rows belonging to a test (by `test_id`)
+TEST_CHILD_MODELS = [ TADAAssertionModel, TADAPhaseModel, TADAMetricModel ]
 
 def conn_module(conn):
     """Get module from connection"""
     m = type(conn).__module__.split('.')[0]
     return importlib.import_module(m)
 
+QPARAM_CACHE = dict() # type(conn) => query param string
+
 def conn_qparam(conn):
     """Determine query param string from connection"""
+    qparam = QPARAM_CACHE.get(type(conn))
+    if qparam:
+        return qparam
+    mod = conn_module(conn)
+    qparam = "?" if mod.paramstyle == "qmark" else "%s"
+    QPARAM_CACHE[type(conn)] = qparam
+    return qparam
+
+DIALECT_TBL = {
+    "sqlite3": "sqlite",
+    "MySQLdb": "mysql",
+    "psycopg2": "pgsql",
+}
+
+def conn_dialect(conn):
+    """Determine SQL dialect ("sqlite", "mysql" or "pgsql") from connection"""
     mod = conn_module(conn)
-    if mod.paramstyle == "qmark":
-        return "?"
-    return "%s"
+    return DIALECT_TBL[mod.__name__]
+
+STREAM_CURSOR_SEQ = itertools.count()
+
+def conn_stream_cursor(conn):
+    """A cursor that fetches the rows from the server as they are consumed
+
+    This is a server-side (named) cursor on pgsql. The sqlite cursors step
+    through the results on their own. The mysql cursor is the regular
+    (client-buffered) cursor, because a mysql unbuffered cursor does not allow
+    other queries on the connection until all of its rows are read.
+    """
+    if conn_dialect(conn) == "pgsql":
+        return conn.cursor(name = "tada_stream_{}".format(next(STREAM_CURSOR_SEQ)))
+    return conn.cursor()
+
+def conn_executemany(conn, cur, sql, params):
+    """`cur.executemany(sql, params)` in as few round trips as the driver can"""
+    if conn_dialect(conn) == "pgsql":
+        # psycopg2 executemany() is a round trip per row
+        from psycopg2.extras import execute_batch
+        execute_batch(cur, sql, params, page_size = 1000)
+    else:
+        cur.executemany(sql, params)
+
+def sql_upsert(conn, table, cols, ids):
+    """Returns the dialect-specific SQL to insert-or-update a row
+
+    `cols` is the list of columns being inserted (including the `ids` columns
+    comprising the primary key). On conflict, the non-id columns in `cols` are
+    updated.
+    """
+    qparam = conn_qparam(conn)
+    dialect = conn_dialect(conn)
+    upd = [ c for c in cols if c not in ids ]
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+                table, ",".join(cols), ",".join([qparam] * len(cols)) )
+    if dialect == "mysql":
+        if not upd:
+            return sql.replace("INSERT", "INSERT IGNORE", 1)
+        return sql + " ON DUPLICATE KEY UPDATE " + \
+                ",".join( "{0}=VALUES({0})".format(c) for c in upd )
+    # sqlite and pgsql
+    if not upd:
+        return sql + " ON CONFLICT ({}) DO NOTHING".format(",".join(ids))
+    return sql + " ON CONFLICT ({}) DO UPDATE SET ".format(",".join(ids)) + \
+            ",".join( "{0}=EXCLUDED.{0}".format(c) for c in upd )
+
+MYSQL_TEXT_PREFIX = 64 # the indexed prefix length of TEXT columns in mysql
+
+def index_exists(conn, table, name):
+    """Check the database catalog if the index `name` on `table` exists"""
+    qparam = conn_qparam(conn)
+    dialect = conn_dialect(conn)
+    if dialect == "sqlite":
+        sql = "SELECT 1 FROM sqlite_master WHERE type='index' AND " \
+              "tbl_name={0} AND name={0}".format(qparam)
+    elif dialect == "pgsql": # unquoted names are folded to lower case
+        sql = "SELECT 1 FROM pg_indexes WHERE schemaname=current_schema() " \
+              "AND tablename={0} AND indexname={0}".format(qparam)
+        table, name = table.lower(), name.lower()
+    else:
+        sql = "SELECT 1 FROM information_schema.statistics WHERE " \
+              "table_schema=DATABASE() AND table_name={0} AND " \
+              "index_name={0}".format(qparam)
+    cur = conn.cursor()
+    cur.execute(sql, (table, name))
+    return bool(cur.fetchall())
 
 def db_loc(host, port):
     if port:
         return host + ":" + str(port)
     return host
 
-def sqlite_connect(db_mod, db_path, **kwargs):
+def sqlite_connect(db_mod, db_path, db_journal_mode="WAL",
+                   db_busy_timeout=30.0, check_same_thread=True, **kwargs):
     log.info("Connecting to sqlite database: {}".format(db_path))
-    return db_mod.connect(db_path)
+    # `timeout` is the busy timeout (seconds) waiting for the other writers
+    conn = db_mod.connect(db_path, timeout=float(db_busy_timeout),
+                          cached_statements=256,
+                          check_same_thread=check_same_thread)
+    if db_journal_mode:
+        # in WAL mode, the readers (e.g. `tadaq`) do not block the writer
+        # (`tadad`) and vice versa. The database must be on a local file
+        # system.
+        conn.execute("PRAGMA journal_mode={}".format(db_journal_mode))
+    # NORMAL is durable in WAL mode except for the last transactions on power
+    # loss, and does not fsync at every commit.
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
 def pgsql_connect(db_mod, db_host="localhost", db_port=None, db_user=None,
                   db_password=None, db_database = None, **kwargs):
@@ -551,6 +1425,244 @@ DB_CONN_TBL = {
     "postgresql"  : ( pgsql_connect  , "psycopg2" ),
 }
 
+class TADAConnPool(object):
+    """A thread-safe pool of database connections
+
+    The threads acquire a connection from the pool, use it exclusively, and
+    release it back to the pool for the other threads to reuse, e.g.
+    >>> pool = TADAConnPool(db_driver="pgsql", max_conns=4, db_host="host",
+    ...                     db_database="somedb", db_user="bla")
+    >>> with pool.connection() as conn:
+    ...     cur = conn.cursor()
+    ...     ...
+    ...     conn.commit()
+    >>> db = TADA_DB(pool = pool) # uses a connection from the pool
+    >>> db.close() # returns the connection to the pool
+
+    At most `max_conns` connections are opened; `acquire()` waits for a
+    connection to be released when all of them are in use. The uncommitted
+    changes are rolled back when the connection is released. This is mainly
+    for pgsql and mysql; the sqlite connections in the pool can be used by
+    any thread (one at a time).
+    """
+    def __init__(self, db_driver = "sqlite", max_conns = 4, **kwargs):
+        ent = DB_CONN_TBL.get(db_driver)
+        if not ent:
+            raise RuntimeError("Unsupported driver: {}".format(db_driver))
+        self.conn_fn, mod_name = ent
+        self.db_mod = importlib.import_module(mod_name)
+        self.max_conns = max_conns
+        self.kwargs = dict(kwargs, check_same_thread = False)
+        self._idle = list()
+        self._count = 0 # the number of opened connections
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout = None):
+        """Get a connection for the exclusive use of the caller"""
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._idle or self._count < self.max_conns,
+                    timeout):
+                raise TimeoutError("No database connection available")
+            if self._idle:
+                return self._idle.pop()
+            self._count += 1
+        try:
+            return self.conn_fn(self.db_mod, **self.kwargs)
+        except:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, discard = False):
+        """Return the connection to the pool, or close it if `discard`"""
+        try:
+            if not discard:
+                conn.rollback() # end the transaction, if any
+        except self.db_mod.Error:
+            discard = True # the connection is broken
+        if discard:
+            try:
+                conn.close()
+            except self.db_mod.Error:
+                pass
+        with self._cond:
+            if discard:
+                self._count -= 1
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close the idle connections"""
+        with self._cond:
+            idle, self._idle = self._idle, list()
+            self._count -= len(idle)
+        for conn in idle:
+            conn.close()
+
+
+class TADACache(object):
+    """Bounded cache of the test and assertion rows known to be in the database
+
+    The cache is used by `TADA_DB.ingest()` to update the known rows and
+    insert the new rows without reading them from the database. The tests are
+    evicted (with their assertions) in the least-recently-used order when
+    there are more than `max_tests` tests in the cache, or when the test has
+    finished and has been written to the database.
+    """
+    def __init__(self, max_tests = 4096):
+        self.max_tests = max_tests
+        self.tests = OrderedDict() # test_id => TADATestModel
+        self.asserts = dict() # test_id => { assert_id => TADAAssertionModel }
+
+    def __len__(self):
+        return len(self.tests)
+
+    def getTest(self, test_id):
+        """Returns the cached TADATestModel or None"""
+        obj = self.tests.get(test_id)
+        if obj is not None:
+            self.tests.move_to_end(test_id)
+        return obj
+
+    def addTest(self, obj):
+        self.tests[obj.test_id] = obj
+        while len(self.tests) > self.max_tests:
+            test_id, _ = self.tests.popitem(last = False)
+            self.asserts.pop(test_id, None)
+
+    def getAssertion(self, test_id, assert_id):
+        """Returns the cached TADAAssertionModel or None"""
+        return self.asserts.get(test_id, {}).get(assert_id)
+
+    def addAssertion(self, obj):
+        if obj.test_id in self.tests:
+            self.asserts.setdefault(obj.test_id, dict())[obj.assert_id] = obj
+
+    def evict(self, test_id):
+        self.tests.pop(test_id, None)
+        self.asserts.pop(test_id, None)
+
+    def clear(self):
+        self.tests.clear()
+        self.asserts.clear()
+
+
+class TADAArchive(object):
+    """Compressed archive of the old test results
+
+    The archive directory contains a partition per month (UTC) of the test
+    start time: `YYYY-MM.jsonl.gz` holding a JSON object per test
+        {"test": {COL: VAL, ...}, "assertions": [ {COL: VAL, ...}, ... ],
+         "phases": [ ... ], "metrics": [ ... ]}
+    and its index `YYYY-MM.index.json` listing the test suites, names, users
+    and commit IDs in the partition. The reader opens only the partitions
+    whose index matches the filters.
+    """
+    INDEX_KEYS = [ "test_suite", "test_name", "test_user", "commit_id" ]
+    CHILDREN = [ ("assertions", TADAAssertionModel),
+                 ("phases", TADAPhaseModel),
+                 ("metrics", TADAMetricModel) ]
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def partition(test_start):
+        """The partition name (YYYY-MM) of the test start time"""
+        return time.strftime("%Y-%m", time.gmtime(test_start or 0))
+
+    def _data_path(self, part):
+        return os.path.join(self.path, part + ".jsonl.gz")
+
+    def _index_path(self, part):
+        return os.path.join(self.path, part + ".index.json")
+
+    def partitions(self):
+        """The list of partition names"""
+        if not os.path.isdir(self.path):
+            return []
+        return sorted( f[:-len(".index.json")] for f in os.listdir(self.path) \
+                       if f.endswith(".index.json") )
+
+    def loadIndex(self, part):
+        with open(self._index_path(part)) as f:
+            return json.load(f)
+
+    def add(self, tests):
+        """Append the tests (with their assertions, phases and metrics)"""
+        os.makedirs(self.path, exist_ok = True)
+        parts = dict()
+        for t in tests:
+            parts.setdefault(self.partition(t.test_start), list()).append(t)
+        for part, _tests in parts.items():
+            # gzip members appended to the file are read as one stream
+            with gzip.open(self._data_path(part), "at") as f:
+                for t in _tests:
+                    rec = { "test": t.as_dict() }
+                    for name, model in self.CHILDREN:
+                        rec[name] = [ o.as_dict() for o in getattr(t, name) ]
+                    f.write(json.dumps(rec) + "\n")
+            try:
+                idx = self.loadIndex(part)
+            except FileNotFoundError:
+                idx = dict( (k, []) for k in self.INDEX_KEYS )
+                idx.update(tests = 0, test_start_min = None,
+                           test_start_max = None)
+            for k in self.INDEX_KEYS:
+                idx[k] = sorted(set(idx[k]) | set( t[k] for t in _tests ),
+                                key = str)
+            starts = [ t.test_start for t in _tests if t.test_start ]
+            if idx["test_start_min"] is not None:
+                starts += [ idx["test_start_min"], idx["test_start_max"] ]
+            idx["test_start_min"] = min(starts) if starts else None
+            idx["test_start_max"] = max(starts) if starts else None
+            idx["tests"] += len(_tests)
+            tmp = self._index_path(part) + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(idx, f)
+            os.replace(tmp, self._index_path(part))
+
+    def iterTests(self, **kwargs):
+        """Iterate over the archived tests matching the filtering conditions
+
+        The tests (`TADATestModel` without database connection) come with
+        their assertions (sorted by numeric assert_id), phases and metrics.
+        """
+        fltr = { k: str(v) for k, v in kwargs.items() }
+        for part in self.partitions():
+            idx = self.loadIndex(part)
+            if any( k in fltr and fltr[k] not in map(str, idx[k]) \
+                    for k in self.INDEX_KEYS ):
+                continue
+            recs = OrderedDict() # test_id => rec, the last copy wins
+            with gzip.open(self._data_path(part), "rt") as f:
+                for line in f:
+                    rec = json.loads(line)
+                    t = rec["test"]
+                    if all( str(t.get(k)) == v for k, v in fltr.items() ):
+                        recs[t["test_id"]] = rec
+            for rec in recs.values():
+                t = TADATestModel(None, [ rec["test"].get(c) \
+                                    for c in TADATestModel.__colnames__ ])
+                for name, model in self.CHILDREN:
+                    setattr(t, "_" + name, [ model(None,
+                            [ d.get(c) for c in model.__colnames__ ]) \
+                            for d in rec.get(name, []) ])
+                t._assertions.sort(key = TADAAssertionModel.sort_key)
+                yield t
+
+
 class TADA_DB(object):
     """TADA database utility
 
@@ -573,31 +1685,141 @@ class TADA_DB(object):
 
     Application may call `db.drop_tables()` to drop (delete) all TADA tables.
 
+    The connection may also be acquired from a `TADAConnPool`, e.g. for each
+    thread, with `TADA_DB(pool = pool)`. `db.close()` returns it to the pool.
+
+    With `archive_dir`, `db.archiveTests()` moves the old tests into the
+    archive (see `TADAArchive`), and `db.iterTestsWithAssertions()` reads the
+    archived tests after those in the database.
+
     See `tadad` python program for an example usage of test data producer, and
     `tadaq` python program for an example usage of test data consumer.
     """
-    def __init__(self, db_driver = "sqlite", **kwargs):
-        ent = DB_CONN_TBL.get(db_driver)
-        if not ent:
-            raise RuntimeError("Unsupported driver: {}".format(db_driver))
-        conn_fn, mod_name = ent
-        db_mod = importlib.import_module(mod_name)
-        self.db_mod = db_mod
-        self.conn = conn_fn(self.db_mod, **kwargs)
+    def __init__(self, db_driver = "sqlite", pool = None, archive_dir = None,
+                 **kwargs):
+        self.pool = pool
+        self.archive = TADAArchive(archive_dir) if archive_dir else None
+        if pool is not None:
+            self.db_mod = pool.db_mod
+            self.conn = pool.acquire()
+        else:
+            ent = DB_CONN_TBL.get(db_driver)
+            if not ent:
+                raise RuntimeError("Unsupported driver: {}".format(db_driver))
+            conn_fn, mod_name = ent
+            db_mod = importlib.import_module(mod_name)
+            self.db_mod = db_mod
+            self.conn = conn_fn(self.db_mod, **kwargs)
         self.init_tables()
 
+    def close(self, discard = False):
+        """Close the connection, or return it to the pool
+
+        If `discard` is True (e.g. the connection is broken), the pooled
+        connection is closed instead of being returned to the pool.
+        """
+        if self.conn is None:
+            return
+        if self.pool is not None:
+            self.pool.release(self.conn, discard = discard)
+        else:
+            self.conn.close()
+        self.conn = None
+
     MODELS = [
+        TADASchemaModel,
         TADATestModel,
         TADAAssertionModel,
+        TADAPhaseModel,
+        TADAMetricModel,
+        TADAAssertionStatModel,
+    ]
+
+    # The schema migrations: (VERSION, DESCRIPTION, METHOD_NAME). The tables
+    # of a new database are created with the latest columns, so the migrations
+    # must do nothing if the changes are already there. Append new migrations
+    # at the end with increasing versions.
+    MIGRATIONS = [
+        ( 1, "add TADATest.test_status and TADAAssertion.assert_ts",
+             "_migrate_v1" ),
+        ( 2, "build TADAAssertionStat from the assertion history",
+             "_migrate_v2" ),
     ]
 
     def init_tables(self):
-        """Initialize TADA tables"""
+        """Initialize TADA tables
+
+        This creates the missing tables, upgrades the schema of an existing
+        database (see `migrate()`) and creates the missing indexes declared in
+        the models.
+        """
         cur = self.conn.cursor()
         for m in self.MODELS:
             sql = m._sql_create_statement()
             cur.execute(sql)
         self.conn.commit()
+        self.migrate()
+        self.create_indexes()
+
+    def schema_version(self):
+        """The version of the last migration applied to the database"""
+        cur = self.conn.cursor()
+        cur.execute("SELECT MAX(version) FROM {}" \
+                    .format(TADASchemaModel.__table__))
+        ver = cur.fetchone()[0]
+        return ver if ver else 0
+
+    def migrate(self):
+        """Apply the migrations newer than the database schema version"""
+        ver = self.schema_version()
+        cols = [ c for c, t in TADASchemaModel.__cols__ ]
+        sql = sql_upsert(self.conn, TADASchemaModel.__table__, cols,
+                         TADASchemaModel.__ids__)
+        for v, desc, fn in self.MIGRATIONS:
+            if v <= ver:
+                continue
+            log.info("Migrating the database schema to version {}: {}" \
+                     .format(v, desc))
+            try:
+                getattr(self, fn)()
+                self.conn.cursor().execute(sql, (v, desc, int(time.time())))
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+
+    def create_indexes(self):
+        """Create the indexes declared in the models if they do not exist"""
+        dialect = conn_dialect(self.conn)
+        cur = self.conn.cursor()
+        for m in self.MODELS:
+            for name, sql in m._sql_index_statements(dialect):
+                if index_exists(self.conn, m.__table__, name):
+                    continue
+                log.info("Creating index {} on {}".format(name, m.__table__))
+                cur.execute(sql)
+        self.conn.commit()
+
+    def _add_columns(self, model, names):
+        # add the columns `names` of `model` that are not in the table
+        cur = self.conn.cursor()
+        cur.execute("SELECT * FROM {} WHERE 1=0".format(model.__table__))
+        cur.fetchall()
+        existing = set( d[0].lower() for d in cur.description )
+        types = dict(model.__cols__)
+        for n in names:
+            if n.lower() in existing:
+                continue
+            log.info("Adding column {}.{}".format(model.__table__, n))
+            cur.execute("ALTER TABLE {} ADD COLUMN {} {}" \
+                        .format(model.__table__, n, types[n]))
+
+    def _migrate_v1(self):
+        self._add_columns(TADATestModel, [ "test_status" ])
+        self._add_columns(TADAAssertionModel, [ "assert_ts" ])
+
+    def _migrate_v2(self):
+        self.rebuildAssertionStats(commit = False)
 
     def drop_tables(self):
         """Drop all TADA tables"""
@@ -611,18 +1833,165 @@ class TADA_DB(object):
         """Create a new test in the DB"""
         return TADATestModel.create(self.conn, *args, **kwargs)
 
-    def findTests(self, latest = False, *args, **kwargs):
-        """Find tests matching the filtering conditions"""
-        objs = TADATestModel.find(self.conn, *args, **kwargs)
+    TEST_KEY = [ "test_suite", "test_type", "test_name", "test_user",
+                 "commit_id" ] # the columns identifying the runs of a test
+
+    def _tests_sql(self, latest = False, order_by = None, **kwargs):
+        """Returns (SQL, PARAMS) selecting the tests matching the conditions
+
+        If `latest` is True, only the latest run (max test_start) of each
+        TEST_KEY is selected by joining with the GROUP BY aggregate, which all
+        drivers support. The runs of a test cannot tie in test_start, as the
+        test_id is derived from the TEST_KEY and test_start. The tests without
+        test_start (test-start message lost) are not selected as latest.
+        """
+        qparam = conn_qparam(self.conn)
+        params = tuple(map(str, kwargs.values()))
+        sql = "SELECT t.* FROM {} t".format(TADATestModel.__table__)
         if latest:
-            objs.sort(key = lambda x: x.test_start)
-            _objs = dict()
-            for o in objs:
-                k = (o.test_suite, o.test_type, o.test_name,
-                     o.test_user, o.commit_id)
-                _objs[k] = o
-            objs = _objs.values()
-        return objs
+            key = ",".join(self.TEST_KEY)
+            sub_cond = " and ".join( "{}={}".format(k, qparam) \
+                                                for k in kwargs.keys() )
+            sql += " JOIN (SELECT {0}, MAX(test_start) AS max_start FROM {1}" \
+                   " {2} GROUP BY {0}) l ON {3} and t.test_start = l.max_start" \
+                   .format(key, TADATestModel.__table__,
+                           "WHERE " + sub_cond if sub_cond else "",
+                           " and ".join( "t.{0}=l.{0}".format(k) \
+                                                for k in self.TEST_KEY ))
+            params = params + params
+        cond = " and ".join( "t.{}={}".format(k, qparam) for k in kwargs.keys() )
+        if cond:
+            sql += " WHERE " + cond
+        if order_by:
+            sql += " ORDER BY " + order_by
+        return sql, params
+
+    def findTests(self, latest = False, **kwargs):
+        """Find tests matching the filtering conditions
+
+        If `latest` is True, only the latest run of each test (same suite,
+        type, name, user and commit_id) is returned.
+        """
+        sql, params = self._tests_sql(latest = latest, **kwargs)
+        cur = self.conn.cursor()
+        cur.execute(sql, params)
+        return [ TADATestModel(self.conn, data) for data in cur.fetchall() ]
+
+    def iterTests(self, latest = False, **kwargs):
+        """Iterate over the tests matching the filtering conditions
+
+        The tests are streamed (see `SQLModel.iter()`) in the order of
+        (test_suite, test_type, test_name, test_user, commit_id, test_start).
+        If `latest` is True, only the latest run of each test is yielded.
+        """
+        order_by = ",".join( "t." + k for k in self.TEST_KEY + [ "test_start" ])
+        sql, params = self._tests_sql(latest = latest, order_by = order_by,
+                                      **kwargs)
+        return TADATestModel.iter_sql(self.conn, sql, params)
+
+    IN_CHUNK = 500 # the maximum number of values in an `IN (...)` list
+
+    PRELOAD = [ (TADAAssertionModel, "_assertions", None),
+                (TADAPhaseModel, "_phases", "phase_no"),
+                (TADAMetricModel, "_metrics", "metric_no") ]
+
+    def _preload(self, tests, metrics = False):
+        # load the assertions, the phases (and the metrics) of `tests` with
+        # one query each
+        by_id = { t.test_id: t for t in tests }
+        qparam = conn_qparam(self.conn)
+        cur = self.conn.cursor()
+        for model, attr, order_by in self.PRELOAD:
+            if model is TADAMetricModel and not metrics:
+                continue
+            for t in tests:
+                setattr(t, attr, list())
+            sql = "SELECT * FROM {} WHERE test_id IN ({})" \
+                  .format(model.__table__, ",".join([qparam] * len(by_id)))
+            if order_by:
+                sql += " ORDER BY test_id, " + order_by
+            cur.execute(sql, tuple(by_id.keys()))
+            for data in cur.fetchall():
+                obj = model(self.conn, data)
+                getattr(by_id[obj.test_id], attr).append(obj)
+        for t in tests:
+            t._assertions.sort(key = TADAAssertionModel.sort_key)
+
+    def iterTestsWithAssertions(self, latest = False, chunk = None, **kwargs):
+        """Like `iterTests()`, with the assertions and phases preloaded
+
+        The tests are streamed in chunks of `chunk` (default: IN_CHUNK) tests,
+        and the assertions (sorted by numeric assert_id) and the phases of
+        each chunk are loaded with one `IN (...)` query each, instead of a
+        query per test when `test.assertions` and `test.phases` are accessed.
+
+        If the database has an archive (see `archive_dir`), the matching
+        archived tests follow the tests in the database. With `latest`, an
+        archived test is yielded only if the test has no run in the database.
+        """
+        tests = self.iterTests(latest = latest, **kwargs)
+        keys = set() # the TEST_KEY of the yielded tests
+        while True:
+            batch = list(itertools.islice(tests, chunk or self.IN_CHUNK))
+            if not batch:
+                break
+            self._preload(batch)
+            if self.archive and latest:
+                keys.update( tuple(t[k] for k in self.TEST_KEY) for t in batch )
+            yield from batch
+        if not self.archive:
+            return
+        archived = self.archive.iterTests(**kwargs)
+        if not latest:
+            yield from archived
+            return
+        _latest = dict()
+        for t in archived:
+            k = tuple(t[k] for k in self.TEST_KEY)
+            if k in keys:
+                continue
+            o = _latest.get(k)
+            if o is None or (t.test_start or 0) > (o.test_start or 0):
+                _latest[k] = t
+        yield from sorted(_latest.values(), key = lambda t: \
+                    tuple(str(t[k]) for k in self.TEST_KEY) + \
+                    (t.test_start or 0, ))
+
+    def archiveTests(self, before, chunk = None):
+        """Move the tests started before `before` (timestamp) to the archive
+
+        The tests are written to the archive (see `TADAArchive`) with their
+        assertions, phases and metrics, and then deleted from the database,
+        `chunk` (default: IN_CHUNK) tests at a time. A test archived but not
+        deleted (e.g. crashed in between) is archived again later; the archive
+        reader keeps only one copy of it.
+
+        Returns the number of archived tests.
+        """
+        if not self.archive:
+            raise RuntimeError("The database has no archive (archive_dir)")
+        sql = "SELECT * FROM {} WHERE test_start < {} ORDER BY test_start" \
+              " LIMIT {}".format(TADATestModel.__table__,
+                                 conn_qparam(self.conn),
+                                 int(chunk or self.IN_CHUNK))
+        count = 0
+        cur = self.conn.cursor()
+        while True:
+            cur.execute(sql, (int(before), ))
+            tests = [ TADATestModel(self.conn, d) for d in cur.fetchall() ]
+            if not tests:
+                break
+            self._preload(tests, metrics = True)
+            self.archive.add(tests)
+            self._delete_tests(tuple( t.test_id for t in tests ))
+            count += len(tests)
+        log.info("{} tests archived".format(count))
+        return count
+
+    def findTestsWithAssertions(self, latest = False, **kwargs):
+        """Find tests matching the filtering conditions, with the assertions
+        and phases preloaded (see `iterTestsWithAssertions()`)"""
+        return list(self.iterTestsWithAssertions(latest = latest, **kwargs))
 
     def findFirst(self, order_by=None, **kwargs):
         """Find the first test macthing the filtering conditions"""
@@ -632,27 +2001,731 @@ class TADA_DB(object):
         """Get the test macthing the criteria or create a new test if not found"""
         return TADATestModel.get(self.conn, *args, **kwargs)
 
-    def purgeOldTests(self):
-        """Purge all old tests"""
-        objs = self.findTests()
-        ATTRS = ["test_suite", "test_type", "test_name", "test_user",
-                 "commit_id", "test_start"]
-        def _cmp_(x, y):
-            for attr in ATTRS:
-                xa = getattr(x, attr)
-                ya = getattr(y, attr)
-                c = cmp(xa, ya)
-                if c:
-                    return c
-            return 0
-        objs.sort(cmp = _cmp_, reverse = True)
-        itr = iter(objs)
-        prev = next(itr)
-        for obj in itr:
-            if prev.equivalent(obj):
-                obj.delete()
+    def _cached_write(self, model, rows, get_obj, add_obj, cacheable):
+        # UPDATE the rows known to the cache, insert-or-update the others
+        known = list()
+        unknown = list()
+        for row in rows:
+            obj = get_obj(row)
+            if obj is None:
+                unknown.append(row)
+                if cacheable(row):
+                    data = [ row.get(c) for c, t in model.__cols__ ]
+                    add_obj(model(self.conn, data))
+                continue
+            for k, v in row.items():
+                setattr(obj, k, v)
+            known.append(obj)
+        model.bulk_update(self.conn, known, commit = False)
+        model.bulk_upsert(self.conn, unknown, commit = False)
+
+    def ingest(self, msgs, cache = None, stats = True):
+        """Write a batch of `tadad` messages into the database
+
+        The messages ("test-start", "assert-status", "phase-begin",
+        "phase-end", "metric", "test-finish" and "test-incomplete") of many
+        tests are folded into test, assertion, phase and metric rows, and
+        written in a single transaction using insert-or-update (no reading
+        back).
+
+        If `cache` (a `TADACache`) is given, the rows known to the cache are
+        written with UPDATE, and the finished tests are evicted from the cache
+        after the transaction is committed.
+
+        The assertion results are also folded into the TADAAssertionStat
+        rollup in the same transaction, unless `stats` is False.
+        """
+        tests = dict()
+        asserts = dict()
+        phases = dict()
+        metrics = dict()
+        for msg in msgs:
+            msg_type = msg.get("msg-type")
+            test_id = msg["test-id"]
+            if msg_type == "test-start":
+                row = tests.setdefault(test_id, { "test_id": test_id })
+                row.update(
+                    test_suite = msg["test-suite"],
+                    test_type = msg["test-type"],
+                    test_name = msg["test-name"],
+                    test_user = msg.get("test-user", "NONE"),
+                    commit_id = msg["commit-id"],
+                    test_desc = msg.get("test-desc", msg["test-name"]),
+                    test_start = int(msg["timestamp"]),
+                    test_status = TADATestModel.RUNNING,
+                )
+            elif msg_type == "assert-status":
+                assert_id = str(msg["assert-no"])
+                asserts[(test_id, assert_id)] = {
+                    "test_id": test_id,
+                    "assert_id": assert_id,
+                    "assert_result": msg["test-status"],
+                    "assert_cond": msg["assert-cond"],
+                    "assert_desc": msg["assert-desc"],
+                    "assert_ts": msg.get("timestamp"),
+                }
+            elif msg_type in ("phase-begin", "phase-end"):
+                phase_no = int(msg["phase-no"])
+                row = phases.setdefault((test_id, phase_no),
+                            { "test_id": test_id, "phase_no": phase_no })
+                if msg_type == "phase-begin":
+                    row.update(
+                        phase_name = msg["phase-name"],
+                        phase_parent = msg.get("phase-parent"),
+                        phase_begin = msg["timestamp"],
+                    )
+                else:
+                    row.update(
+                        phase_end = msg["timestamp"],
+                        phase_status = msg.get("phase-status"),
+                    )
+            elif msg_type == "metric":
+                metric_no = int(msg["metric-no"])
+                tags = msg.get("metric-tags")
+                metrics[(test_id, metric_no)] = {
+                    "test_id": test_id,
+                    "metric_no": metric_no,
+                    "metric_name": msg["metric-name"],
+                    "metric_value": float(msg["metric-value"]),
+                    "metric_unit": msg.get("metric-unit"),
+                    "metric_tags": json.dumps(tags, sort_keys = True) \
+                                   if tags else None,
+                    "metric_ts": msg.get("timestamp"),
+                }
+            elif msg_type == "test-finish":
+                row = tests.setdefault(test_id, { "test_id": test_id })
+                row["test_finish"] = int(msg["timestamp"])
+                row["test_status"] = TADATestModel.FINISHED
+            elif msg_type == "test-incomplete":
+                # from `tadad`, the test was abandoned before finishing
+                row = tests.setdefault(test_id, { "test_id": test_id })
+                row["test_status"] = TADATestModel.INCOMPLETE
+        try:
+            if cache is None:
+                TADATestModel.bulk_upsert(self.conn, tests.values(),
+                                          commit = False)
+                TADAAssertionModel.bulk_upsert(self.conn, asserts.values(),
+                                               commit = False)
             else:
-                prev = obj
+                self._cached_write(TADATestModel, tests.values(),
+                        lambda r: cache.getTest(r["test_id"]), cache.addTest,
+                        # only a test-start gives the complete test row
+                        lambda r: "test_start" in r)
+                self._cached_write(TADAAssertionModel, asserts.values(),
+                        lambda r: cache.getAssertion(r["test_id"], r["assert_id"]),
+                        cache.addAssertion, lambda r: True)
+            # phases and metrics are written at most twice, no caching needed
+            TADAPhaseModel.bulk_upsert(self.conn, phases.values(),
+                                       commit = False)
+            TADAMetricModel.bulk_upsert(self.conn, metrics.values(),
+                                        commit = False)
+            if stats:
+                self._update_assertion_stats(tests.values())
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            if cache is not None:
+                cache.clear() # the cached rows may not be in the database
+            raise
+        if cache is not None:
+            for test_id, row in tests.items():
+                if row.get("test_status") in (TADATestModel.FINISHED,
+                                              TADATestModel.INCOMPLETE):
+                    cache.evict(test_id)
+
+    def _stat_cond(self, tests):
+        # WHERE condition and params selecting the (test_suite, test_name)
+        # `tests` in a table aliased `t`
+        qparam = conn_qparam(self.conn)
+        cond = " or ".join([ "(t.test_suite={0} and t.test_name={0})" \
+                             .format(qparam) ] * len(tests))
+        return "WHERE (" + cond + ")", tuple(itertools.chain(*tests))
+
+    def _update_assertion_stats(self, tests):
+        # fold the results of the test runs completing in this batch (`tests`
+        # are the test rows being written) into the rollup. A run is folded
+        # once, when it completes, so the batches without a test-finish (or
+        # test-incomplete) do not read anything. The results are read back
+        # from the database (the batch is already written in the transaction)
+        # because the assertions of a run may be spread over many batches.
+        done = [ r["test_id"] for r in tests \
+                 if r.get("test_status") in (TADATestModel.FINISHED,
+                                             TADATestModel.INCOMPLETE) ]
+        if not done:
+            return
+        qparam = conn_qparam(self.conn)
+        cur = self.conn.cursor()
+        runs = dict() # (test_suite, test_name, assert_id) => [ (start, id, result) ]
+        for i in range(0, len(done), self.IN_CHUNK):
+            ids = tuple(done[i:i+self.IN_CHUNK])
+            cur.execute("SELECT t.test_suite, t.test_name, a.assert_id,"
+                        " t.test_start, t.test_id, a.assert_result"
+                        " FROM {} a JOIN {} t ON t.test_id = a.test_id"
+                        " WHERE t.test_id IN ({}) and t.test_suite IS NOT NULL" \
+                        .format(TADAAssertionModel.__table__,
+                                TADATestModel.__table__,
+                                ",".join([qparam] * len(ids))), ids)
+            for suite, name, assert_id, start, test_id, result in cur.fetchall():
+                runs.setdefault((suite, name, assert_id), list()) \
+                    .append( (start or 0, test_id, result) )
+        if not runs:
+            return
+        tests = list(set( k[:2] for k in runs ))
+        rows = dict() # (test_suite, test_name, assert_id) => row
+        cols = [ c for c, t in TADAAssertionStatModel.__cols__ ]
+        for i in range(0, len(tests), self.IN_CHUNK):
+            cond, params = self._stat_cond(tests[i:i+self.IN_CHUNK])
+            cur.execute("SELECT * FROM {} t {}" \
+                        .format(TADAAssertionStatModel.__table__, cond), params)
+            for data in cur.fetchall():
+                row = dict(zip(cols, data))
+                rows[(row["test_suite"], row["test_name"],
+                      row["assert_id"])] = row
+        late = dict() # (test_suite, test_name) => the earliest late run
+        late_keys = set()
+        for key, lst in runs.items():
+            lst.sort()
+            row = rows.setdefault(key, dict(zip(TADAAssertionStatModel.__ids__,
+                                                key)))
+            last = (row.get("last_start") or 0, row.get("last_test_id") or "")
+            if row.get("last_results") and lst[0][1] != last[1] and \
+                    lst[0][:2] < last:
+                # a concurrent run that started before the last run folded
+                # completes after it, see below
+                late[key[:2]] = min(late.get(key[:2], lst[0][:2]), lst[0][:2])
+                late_keys.add(key)
+                continue
+            for start, test_id, result in lst:
+                TADAAssertionStatModel.fold(row, test_id, start, result)
+        rebuild = list()
+        for (suite, name), (start, test_id) in late.items():
+            # fold the late runs in the order of the start time by refolding
+            # the (completed) runs started after them, without losing the
+            # counts of the runs purged from the history
+            cur.execute("SELECT a.assert_id, t.test_start, t.test_id,"
+                        " a.assert_result FROM {} a JOIN {} t"
+                        " ON t.test_id = a.test_id WHERE t.test_suite={q} and"
+                        " t.test_name={q} and t.test_start>={q} and"
+                        " (t.test_status IS NULL or t.test_status<>{q})" \
+                        .format(TADAAssertionModel.__table__,
+                                TADATestModel.__table__, q = qparam),
+                        (suite, name, start, TADATestModel.RUNNING))
+            hist = dict() # assert_id => [ (start, id, result) ]
+            for assert_id, _start, _id, result in cur.fetchall():
+                hist.setdefault(assert_id, list()) \
+                    .append( (_start or 0, _id, result) )
+            for assert_id, lst in hist.items():
+                key = (suite, name, assert_id)
+                if key not in late_keys:
+                    continue
+                row = rows[key]
+                lst = sorted( h for h in lst if h[:2] >= runs[key][0][:2] )
+                new = set( r[1] for r in runs[key] ) - \
+                      set([ row.get("last_test_id") ])
+                n = sum( h[1] not in new for h in lst )
+                if not TADAAssertionStatModel.refold(row, n, lst):
+                    rebuild.append( (suite, name) )
+                    break
+        TADAAssertionStatModel.bulk_upsert(self.conn, rows.values(),
+                                           commit = False)
+        if rebuild:
+            self.rebuildAssertionStats(rebuild, commit = False)
+
+    def rebuildAssertionStats(self, tests = None, commit = True):
+        """Rebuild the TADAAssertionStat rollup from the assertion history
+
+        `tests` optionally limits the rebuild to a list of (test_suite,
+        test_name). The history of the completed test runs is streamed in the
+        order of the test start time and folded as in `ingest()`. If `commit` is False, the caller is
+        responsible for committing the transaction.
+
+        Returns the number of rollup rows written.
+        """
+        tbl = TADAAssertionStatModel.__table__
+        chunks = [ None ] if tests is None else \
+                 [ list(tests)[i:i+self.IN_CHUNK] \
+                                for i in range(0, len(tests), self.IN_CHUNK) ]
+        count = 0
+        cur = self.conn.cursor()
+        try:
+            for chunk in chunks:
+                cond, params = self._stat_cond(chunk) if chunk else ("", ())
+                cur.execute("DELETE FROM {} {}".format(tbl,
+                                cond.replace("t.", "")), params)
+                # the tests without test-start have no suite and name, and
+                # the running tests are folded when they complete
+                cond = (cond + " and " if cond else "WHERE ") + \
+                       "t.test_suite IS NOT NULL and (t.test_status IS NULL" \
+                       " or t.test_status<>'{}')".format(TADATestModel.RUNNING)
+                sql = "SELECT t.test_suite, t.test_name, a.assert_id," \
+                      " a.assert_result, t.test_id, t.test_start" \
+                      " FROM {} a JOIN {} t ON t.test_id = a.test_id {}" \
+                      " ORDER BY t.test_suite, t.test_name, a.assert_id," \
+                      " t.test_start, t.test_id" \
+                      .format(TADAAssertionModel.__table__,
+                              TADATestModel.__table__, cond)
+                rows = list()
+                scur = conn_stream_cursor(self.conn)
+                try:
+                    scur.execute(sql, params)
+                    while True:
+                        lst = scur.fetchmany(SQLModel.ITER_BATCH)
+                        if not lst:
+                            break
+                        for suite, name, assert_id, result, test_id, start \
+                                in lst:
+                            key = (suite, name, assert_id)
+                            if not rows or rows[-1][0] != key:
+                                if len(rows) >= SQLModel.ITER_BATCH:
+                                    TADAAssertionStatModel.bulk_upsert(
+                                        self.conn, [ r for k, r in rows ],
+                                        commit = False)
+                                    count += len(rows)
+                                    rows = list()
+                                rows.append( (key, dict(zip(
+                                    TADAAssertionStatModel.__ids__, key))) )
+                            TADAAssertionStatModel.fold(rows[-1][1], test_id,
+                                                        start, result)
+                finally:
+                    scur.close()
+                TADAAssertionStatModel.bulk_upsert(self.conn,
+                        [ r for k, r in rows ], commit = False)
+                count += len(rows)
+            if commit:
+                self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        log.info("{} assertion stats rebuilt".format(count))
+        return count
+
+    def flakyAssertions(self, window = 20, min_flips = 1, **kwargs):
+        """Find the assertions flipping between passed and failed
+
+        Only the TADAAssertionStat rollup is read. `kwargs` are the
+        test_suite and test_name filters. Returns a list of
+        (TADAAssertionStatModel, FLIPS) of the assertions with at least
+        `min_flips` flips within their last `window` results, the most
+        flipping first.
+        """
+        if window > TADAAssertionStatModel.WINDOW:
+            raise ValueError("window must not exceed {}" \
+                             .format(TADAAssertionStatModel.WINDOW))
+        ret = list()
+        for o in TADAAssertionStatModel.iter(self.conn, **kwargs):
+            flips = o.window_flips(window)
+            if flips >= min_flips:
+                ret.append( (o, flips) )
+        ret.sort(key = lambda x: (-x[1], x[0].test_suite, x[0].test_name,
+                                  TADAAssertionModel.id_key(x[0].assert_id)))
+        return ret
+
+    def _read_journal(self, path):
+        # the messages of a journal, with "test-incomplete" if not finished
+        msgs = list()
+        finished = False
+        test_id = None
+        with open(path) as f:
+            for lno, line in enumerate(f, 1):
+                try:
+                    msg = json.loads(line)
+                    err = check_msg(msg) if type(msg) == dict \
+                                         else "not a message"
+                except ValueError as e:
+                    err = e
+                if err:
+                    log.warning("{}:{}: bad message, skipped: {}" \
+                                .format(path, lno, err))
+                    continue
+                test_id = msg["test-id"]
+                finished = finished or msg.get("msg-type") == "test-finish"
+                msgs.append(msg)
+        if test_id and not finished:
+            msgs.append({ "msg-type": "test-incomplete", "test-id": test_id })
+        return msgs
+
+    def _check_msgs(self, path, msgs):
+        # the messages of a results document that can be written
+        ret = list()
+        for i, msg in enumerate(msgs):
+            err = check_msg(msg)
+            if err:
+                log.warning("{}: message {} ({}) skipped: {}" \
+                            .format(path, i, msg.get("msg-type"), err))
+                continue
+            ret.append(msg)
+        return ret
+
+    def importJournals(self, paths, batch_max = 50000):
+        """Import the journals written by `Test` in spool mode
+
+        `paths` is a list of journal files (`{test_id}.jsonl`), results
+        documents (`*.json`, see `parse_results()`) or directories containing
+        them. The messages are written in transactions of up to
+        `batch_max` messages (see `ingest()`). A malformed message (see
+        `check_msg()`) is skipped with a warning. Re-importing a journal is
+        harmless as the rows are insert-or-update by test_id and assert_id. A
+        test without "test-finish" in its journal is marked incomplete. The
+        TADAAssertionStat rollup of the imported tests is rebuilt afterward,
+        so that the re-imported results are not counted twice.
+
+        Returns the number of imported journals.
+        """
+        files = list()
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(sorted( os.path.join(path, f) \
+                        for f in os.listdir(path) \
+                        if f.endswith(".jsonl") or f.endswith(".json") ))
+            else:
+                files.append(path)
+        batch = list()
+        tests = set() # (test_suite, test_name) of the imported tests
+        for path in files:
+            if path.endswith(".json"):
+                try:
+                    with open(path) as f:
+                        msgs = parse_results(f.read())
+                except ValueError as e:
+                    log.warning("{}: bad results document, skipped: {}" \
+                                .format(path, e))
+                    continue
+                msgs = self._check_msgs(path, msgs)
+            else:
+                msgs = self._read_journal(path)
+            for msg in msgs:
+                if msg.get("msg-type") == "test-start":
+                    tests.add( (msg.get("test-suite"), msg.get("test-name")) )
+            batch.extend(msgs)
+            if len(batch) >= batch_max:
+                self.ingest(batch, stats = False)
+                batch = list()
+        if batch:
+            self.ingest(batch, stats = False)
+        if tests:
+            self.rebuildAssertionStats(sorted(tests))
+        return len(files)
+
+    def _test_cond(self, **kwargs):
+        # WHERE clause and params filtering TADATest (aliased `t`) columns
+        qparam = conn_qparam(self.conn)
+        cond = " and ".join( "t.{}={}".format(k, qparam) for k in kwargs.keys() )
+        return ("WHERE " + cond if cond else ""), tuple(map(str, kwargs.values()))
+
+    def findMetrics(self, metric_name = None, **kwargs):
+        """Find the metrics of the tests matching the filtering conditions
+
+        `kwargs` are the TADATest column filters (e.g. `commit_id="abc"`).
+        Returns a list of (TADATestModel, [TADAMetricModel, ...]) ordered by
+        test start time.
+        """
+        cond, params = self._test_cond(**kwargs)
+        if metric_name is not None:
+            cond += (" and " if cond else "WHERE ") + \
+                    "m.metric_name={}".format(conn_qparam(self.conn))
+            params += (metric_name, )
+        tcols = [ c for c, t in TADATestModel.__cols__ ]
+        mcols = [ c for c, t in TADAMetricModel.__cols__ ]
+        sql = "SELECT {}, {} FROM {} m JOIN {} t ON t.test_id = m.test_id {}" \
+              " ORDER BY t.test_start, t.test_id, m.metric_no".format(
+                  ",".join("t."+c for c in tcols),
+                  ",".join("m."+c for c in mcols),
+                  TADAMetricModel.__table__, TADATestModel.__table__, cond)
+        cur = self.conn.cursor()
+        cur.execute(sql, params)
+        ret = list()
+        for data in cur.fetchall():
+            tdata, mdata = data[:len(tcols)], data[len(tcols):]
+            if not ret or ret[-1][0].test_id != tdata[0]:
+                ret.append( (TADATestModel(self.conn, tdata), list()) )
+            ret[-1][1].append(TADAMetricModel(self.conn, mdata))
+        return ret
+
+    def metricTrend(self, metric_name = None, **kwargs):
+        """Aggregate the metrics per commit_id
+
+        `kwargs` are the TADATest column filters. Returns a list of
+        (test_suite, test_name, metric_name, metric_unit, commit_id, count,
+        avg, min, max, first_start) tuples, ordered by the first test start
+        time of each commit_id within a (test_suite, test_name, metric_name).
+        """
+        cond, params = self._test_cond(**kwargs)
+        if metric_name is not None:
+            cond += (" and " if cond else "WHERE ") + \
+                    "m.metric_name={}".format(conn_qparam(self.conn))
+            params += (metric_name, )
+        sql = "SELECT t.test_suite, t.test_name, m.metric_name," \
+              " m.metric_unit, t.commit_id, COUNT(*), AVG(m.metric_value)," \
+              " MIN(m.metric_value), MAX(m.metric_value)," \
+              " MIN(t.test_start) AS first_start" \
+              " FROM {} m JOIN {} t ON t.test_id = m.test_id {}" \
+              " GROUP BY t.test_suite, t.test_name, m.metric_name," \
+              " m.metric_unit, t.commit_id" \
+              " ORDER BY t.test_suite, t.test_name, m.metric_name," \
+              " first_start".format(TADAMetricModel.__table__,
+                                    TADATestModel.__table__, cond)
+        cur = self.conn.cursor()
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+    def commitResults(self, commit_id, **kwargs):
+        """The assertion results of the latest runs of a commit, in one query
+
+        `kwargs` are the TADATest column filters (other than commit_id).
+        Returns a list of (test_suite, test_type, test_name, test_user,
+        assert_id, assert_result, assert_desc, test_start, test_finish) tuples
+        ordered by test_start.
+        A test without assertions has a row with NULL assert_id.
+        """
+        tests, params = self._tests_sql(latest = True, commit_id = commit_id,
+                                        **kwargs)
+        sql = "SELECT t.test_suite, t.test_type, t.test_name, t.test_user," \
+              " a.assert_id, a.assert_result, a.assert_desc, t.test_start," \
+              " t.test_finish" \
+              " FROM ({}) t LEFT JOIN {} a ON a.test_id = t.test_id" \
+              " ORDER BY t.test_start".format(tests,
+                                              TADAAssertionModel.__table__)
+        cur = self.conn.cursor()
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+    DIFF_KINDS = [ "failing", "passing", "skipped", "missing" ]
+
+    def diffCommits(self, base, head, duration_threshold = 0.2,
+                    duration_min = 5, **kwargs):
+        """Compare the latest results of commit `head` against commit `base`
+
+        Each side is loaded with one query (see `commitResults()`). As in
+        `findTests()`, a test is identified by (test_suite, test_type,
+        test_name, test_user), so the runs of different users or types are
+        compared separately. Returns a dictionary:
+          - "failing", "passing", "skipped": the assertions whose result in
+            `head` is failed, passed or skipped, and differs from `base`. The
+            new assertions (not in `base`) that passed are not reported.
+          - "missing": the assertions in `base` but not in `head`.
+          Each entry is (test_suite, test_type, test_name, test_user,
+          assert_id, assert_desc, base_result, head_result), the results being
+          None if missing.
+          - "durations": (test_suite, test_type, test_name, test_user,
+            base_duration, head_duration) of the tests whose duration (test_finish - test_start, in seconds)
+            changed by at least `duration_threshold` (relative to the base)
+            and `duration_min` seconds.
+        """
+        sides = list()
+        for commit_id in (base, head):
+            asserts = dict() # (suite, type, name, user, assert_id) => (result, desc)
+            durations = dict() # (suite, type, name, user) => duration
+            for row in self.commitResults(commit_id, **kwargs):
+                test, (assert_id, result, desc, start, finish) = \
+                                                        row[:4], row[4:]
+                # ordered by test_start, the latest run overrides the others
+                durations[test] = finish - start \
+                                    if start is not None and \
+                                       finish is not None else None
+                if assert_id is not None:
+                    asserts[test + (assert_id,)] = (result, desc)
+            sides.append((asserts, durations))
+        (b_asserts, b_durs), (h_asserts, h_durs) = sides
+        ret = { k: list() for k in self.DIFF_KINDS + [ "durations" ] }
+        for k in sorted(set(b_asserts) | set(h_asserts),
+                        key = lambda k: tuple( v or "" for v in k[:4] ) + \
+                                        (TADAAssertionModel.id_key(k[4]),)):
+            b_res, b_desc = b_asserts.get(k, (None, None))
+            h_res, h_desc = h_asserts.get(k, (None, None))
+            if b_res == h_res:
+                continue
+            ent = k + (h_desc or b_desc, b_res, h_res)
+            if h_res is None:
+                ret["missing"].append(ent)
+            elif h_res == "failed":
+                ret["failing"].append(ent)
+            elif h_res == "skipped":
+                ret["skipped"].append(ent)
+            elif h_res == "passed" and b_res is not None:
+                ret["passing"].append(ent)
+        for k in sorted(set(b_durs) & set(h_durs),
+                        key = lambda k: tuple( v or "" for v in k )):
+            b, h = b_durs[k], h_durs[k]
+            if b is None or h is None:
+                continue
+            delta = abs(h - b)
+            if delta >= duration_min and delta >= duration_threshold * b:
+                ret["durations"].append(k + (b, h))
+        return ret
+
+    def durationTrend(self, **kwargs):
+        """Aggregate the test durations (test_finish - test_start) per
+        commit_id
+
+        `kwargs` are the TADATest column filters. Only the finished tests are
+        counted. Returns a list of (test_suite, test_name, commit_id, count,
+        avg, min, max, first_start) tuples, ordered by the first test start
+        time of each commit_id within a (test_suite, test_name).
+        """
+        cond, params = self._test_cond(**kwargs)
+        cond += (" and " if cond else "WHERE ") + \
+                "t.test_start IS NOT NULL and t.test_finish IS NOT NULL"
+        sql = "SELECT t.test_suite, t.test_name, t.commit_id, COUNT(*)," \
+              " AVG(t.test_finish - t.test_start)," \
+              " MIN(t.test_finish - t.test_start)," \
+              " MAX(t.test_finish - t.test_start)," \
+              " MIN(t.test_start) AS first_start" \
+              " FROM {} t {}" \
+              " GROUP BY t.test_suite, t.test_name, t.commit_id" \
+              " ORDER BY t.test_suite, t.test_name, first_start" \
+              .format(TADATestModel.__table__, cond)
+        cur = self.conn.cursor()
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+    def durationSlowdowns(self, commit_id = None, baseline = 10,
+                          threshold = 3.0, min_delta = 5, min_runs = 3,
+                          trend = None, **kwargs):
+        """Find the tests that became slower in a commit
+
+        The average duration of each test (see `durationTrend()`) in the
+        commit `commit_id` (default: the last commit the test ran on) is
+        compared against the `baseline` commits preceding it. The test is
+        flagged if the duration exceeds the baseline median by more than
+        `threshold` scaled MADs (median absolute deviation * 1.4826, a robust
+        standard deviation) and by more than `min_delta` seconds. The tests
+        with less than `min_runs` baseline commits are not flagged. `trend`
+        is the result of `durationTrend(**kwargs)` if the caller already has
+        it.
+
+        Returns a list of (test_suite, test_name, commit_id, duration, median,
+        mad, n_baseline) of the flagged tests, the largest relative slowdown
+        first.
+        """
+        series = dict() # (test_suite, test_name) => [ (commit_id, avg) ]
+        if trend is None:
+            trend = self.durationTrend(**kwargs)
+        for suite, name, commit, count, avg, _min, _max, start in trend:
+            # AVG() is DECIMAL on mysql and pgsql
+            series.setdefault((suite, name), list()).append( (commit,
+                                                              float(avg)) )
+        ret = list()
+        for (suite, name), pts in series.items():
+            commits = [ c for c, v in pts ]
+            if commit_id is None:
+                idx = len(pts) - 1
+            elif commit_id in commits:
+                idx = commits.index(commit_id)
+            else:
+                continue
+            base = [ v for c, v in pts[max(idx - baseline, 0):idx] ]
+            if len(base) < min_runs:
+                continue
+            med = statistics.median(base)
+            mad = statistics.median( abs(v - med) for v in base ) * 1.4826
+            dur = pts[idx][1]
+            if dur - med > max(threshold * mad, min_delta):
+                ret.append( (suite, name, pts[idx][0], dur, med, mad,
+                             len(base)) )
+        ret.sort(key = lambda x: (x[3] - x[4]) / x[4] if x[4] else float("inf"),
+                 reverse = True)
+        return ret
+
+    def _delete_tests(self, test_ids):
+        # delete the tests and their rows in other tables, in one transaction
+        qparam = conn_qparam(self.conn)
+        cond = "test_id IN ({})".format(",".join([qparam] * len(test_ids)))
+        cur = self.conn.cursor()
+        try:
+            for m in TEST_CHILD_MODELS + [ TADATestModel ]:
+                cur.execute("DELETE FROM {} WHERE {}".format(m.__table__, cond),
+                            test_ids)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+
+    def _delete_selected(self, sql, params = (), chunk = None):
+        # delete the tests whose test_id are selected by `sql` in transactions
+        # of `chunk` tests; returns the number of deleted tests. The selection
+        # runs once, re-running it for each chunk is quadratic on large
+        # databases.
+        cur = self.conn.cursor()
+        cur.execute(sql, params)
+        test_ids = [ r[0] for r in cur.fetchall() ]
+        chunk = int(chunk or self.IN_CHUNK)
+        for i in range(0, len(test_ids), chunk):
+            self._delete_tests(tuple(test_ids[i:i+chunk]))
+        return len(test_ids)
+
+    def purgeOldTests(self, keep_commits = None, keep_days = None,
+                      compact = True, chunk = None):
+        """Purge all old tests
+
+        The old runs of each test (same suite, type, name, user and
+        commit_id), i.e. all but the latest run, are deleted with their
+        assertions, phases and metrics in transactions of `chunk` (default:
+        IN_CHUNK) tests. Optionally, the retention policy also deletes the
+        tests of all but the `keep_commits` most recently tested commit IDs,
+        and the tests started more than `keep_days` days ago. Then, the
+        database is compacted (see `compact()`) unless `compact` is False.
+
+        Returns the number of deleted tests.
+        """
+        tbl = TADATestModel.__table__
+        key = ",".join(self.TEST_KEY)
+        count = self._delete_selected(
+                "SELECT t.test_id FROM {0} t JOIN (SELECT {1}, MAX(test_start)"
+                " AS max_start FROM {0} GROUP BY {1}) l ON {2} and"
+                " t.test_start < l.max_start".format(tbl, key,
+                    " and ".join( "t.{0}=l.{0}".format(k) \
+                                            for k in self.TEST_KEY )),
+                chunk = chunk)
+        if keep_days is not None:
+            ts = int(time.time() - keep_days * 86400)
+            count += self._delete_selected(
+                    "SELECT test_id FROM {} WHERE test_start < {}" \
+                    .format(tbl, conn_qparam(self.conn)), (ts, ),
+                    chunk = chunk)
+        if keep_commits is not None:
+            cur = self.conn.cursor()
+            cur.execute("SELECT commit_id, MAX(test_start) AS last_start"
+                        " FROM {} GROUP BY commit_id ORDER BY last_start DESC" \
+                        .format(tbl))
+            old = [ r[0] for r in cur.fetchall()[keep_commits:] ]
+            for i in range(0, len(old), self.IN_CHUNK):
+                commits = tuple(old[i:i+self.IN_CHUNK])
+                count += self._delete_selected(
+                        "SELECT test_id FROM {} WHERE commit_id IN ({})" \
+                        .format(tbl, ",".join([conn_qparam(self.conn)] * \
+                                              len(commits))),
+                        commits, chunk = chunk)
+        log.info("{} tests purged".format(count))
+        if compact:
+            self.compact()
+        return count
+
+    def compact(self):
+        """Reclaim the space of the deleted rows and update the statistics
+
+        This is VACUUM and ANALYZE on sqlite (the database file shrinks) and
+        pgsql, and OPTIMIZE TABLE on mysql.
+        """
+        self.conn.commit()
+        dialect = conn_dialect(self.conn)
+        tables = [ m.__table__ for m in self.MODELS ]
+        if dialect == "sqlite":
+            self.conn.execute("VACUUM")
+            self.conn.execute("ANALYZE")
+        elif dialect == "pgsql":
+            # VACUUM cannot run inside a transaction block
+            autocommit = self.conn.autocommit
+            self.conn.autocommit = True
+            try:
+                cur = self.conn.cursor()
+                for t in tables:
+                    cur.execute("VACUUM ANALYZE {}".format(t))
+            finally:
+                self.conn.autocommit = autocommit
+        else:
+            cur = self.conn.cursor()
+            cur.execute("OPTIMIZE TABLE {}".format(",".join(tables)))
+            cur.fetchall()
 
 
 if __name__ == "__main__":
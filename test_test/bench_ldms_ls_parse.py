@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+#
+# Benchmark `parse_ldms_ls()` with synthetic `ldms_ls -l -v` outputs of many
+# sets, e.g.
+#
+#   ./bench_ldms_ls_parse.py --sets 10000 100000
+#
+
+import sys
+import time
+import argparse
+
+from LDMS_Test import parse_ldms_ls
+
+ap = argparse.ArgumentParser(description = "parse_ldms_ls() benchmark")
+ap.add_argument("--sets", type = int, nargs = "+", default = [10000, 100000],
+                help = "Numbers of sets in the synthetic outputs.")
+ap.add_argument("--scalars", type = int, default = 16,
+                help = "Number of scalar metrics in each set.")
+ap.add_argument("--arrays", type = int, default = 4,
+                help = "Number of array metrics in each set.")
+ap.add_argument("--array-len", type = int, default = 8,
+                help = "Length of each array metric.")
+ap.add_argument("--repeat", type = int, default = 1,
+                help = "Number of parses of each output (the best is reported).")
+args = ap.parse_args()
+
+HDR = "Schema         Instance                 Flags  Msize  Dsize  Hsize  UID    GID    Perm       Update            Duration          Info"
+DASHES = "-------------- ------------------------ ------ ------ ------ ------ ------ ------ ---------- ----------------- ----------------- --------"
+
+def gen_output(num_sets):
+    """Generate `ldms_ls -l -v` output of `num_sets` sets"""
+    lines = [
+        "Hostname    : agg-1",
+        "IP Address  : 10.100.0.2",
+        "Port        : 10000",
+        "Transport   : sock",
+        "",
+        HDR,
+        DASHES,
+    ]
+    names = [ "node-{:06d}/bench".format(i) for i in range(num_sets) ]
+    for name in names:
+        lines.append("bench          {:24} CL       2032    432      0  0      0      -rwxrwxrwx 1566328023.001611          0.000155 \"updt_hint_us\"=\"1000000:0\"".format(name))
+    lines.append(DASHES)
+    lines.append("Total Sets: {}, Meta Data (kB): 2.46, Data (kB) 0.63, Memory (kB): 3.10".format(num_sets))
+    lines.append("")
+    lines.append("=" * 71)
+    lines.append("")
+    arr = ",".join(str(1000 + j) for j in range(args.array_len))
+    body = [ "M u64        component_id                               10001" ]
+    body += [ "D u64        metric_{:<3}                                 {}".format(j, 123456789 + j)
+              for j in range(args.scalars - 2) ]
+    body += [ "D d64        load_avg                                   0.250000" ]
+    body += [ "D u64[]      array_{:<3}                                  {}".format(j, arr)
+              for j in range(args.arrays) ]
+    for i, name in enumerate(names):
+        lines.append("{}: consistent, last update: Tue Aug 20 19:07:03 2019 +0000 [1611us]".format(name))
+        lines.extend(body)
+        lines.append("")
+    return "\n".join(lines) + "\n", len(lines)
+
+for num_sets in args.sets:
+    txt, num_lines = gen_output(num_sets)
+    best = None
+    for i in range(args.repeat):
+        t0 = time.perf_counter()
+        sets = parse_ldms_ls(txt)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    assert(len(sets) == num_sets)
+    s = sets["node-{:06d}/bench".format(num_sets - 1)]
+    assert(s["meta"]["schema"] == "bench")
+    assert(len(s["data"]) == args.scalars + args.arrays)
+    assert(len(s["data"]["array_0"]) == args.array_len)
+    print("sets: {:7d}  lines: {:8d}  time: {:7.3f} s  lines/sec: {:10.0f}"
+          .format(num_sets, num_lines, best, num_lines / best))
+    sys.stdout.flush()
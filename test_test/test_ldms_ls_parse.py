@@ -2,16 +2,17 @@
 
 import os
 import sys
+import json
 import argparse
 
 from LDMS_Test import parse_ldms_ls
 
 out = """\
-Schema         Instance                 Flags  Msize  Dsize  UID    GID    Perm       Update            Duration          Info
--------------- ------------------------ ------ ------ ------ ------ ------ ---------- ----------------- ----------------- --------
-syspapi-1      compute-1/syspapi           CL     432    200      0      0 -rwxrwxrwx 1566328023.001436          0.000045 "updt_hint_us"="1000000:0"
-meminfo        compute-1/meminfo           CL    2032    432      0      0 -rwxrwxrwx 1566328023.001611          0.000155 "updt_hint_us"="1000000:0"
--------------- ------------------------ ------ ------ ------ ------ ------ ---------- ----------------- ----------------- --------
+Schema         Instance                 Flags  Msize  Dsize  Hsize  UID    GID    Perm       Update            Duration          Info
+-------------- ------------------------ ------ ------ ------ ------ ------ ------ ---------- ----------------- ----------------- --------
+syspapi-1      compute-1/syspapi           CL     432    200      0      0      0 -rwxrwxrwx 1566328023.001436          0.000045 "updt_hint_us"="1000000:0"
+meminfo        compute-1/meminfo           CL    2032    432      0      0      0 -rwxrwxrwx 1566328023.001611          0.000155 "updt_hint_us"="1000000:0"
+-------------- ------------------------ ------ ------ ------ ------ ------ ------ ---------- ----------------- ----------------- --------
 Total Sets: 2, Meta Data (kB): 2.46, Data (kB) 0.63, Memory (kB): 3.10
 
 =======================================================================
@@ -90,9 +91,11 @@ syspapi_expect = {
     "perm": "-rwxrwxrwx",
     "instance": "compute-1/syspapi",
     "gid": "0",
-    "flags": "CL",
+    "flags": "CL    ", # keeps the padding up to the Msize column
     "duration": "0.000045",
     "data_sz": "200",
+    "heap_sz": "0",
+    "schema_digest": None,
     "schema": "syspapi-1"
   },
   "data": {
@@ -148,9 +151,11 @@ meminfo_expect = {
     "perm": "-rwxrwxrwx",
     "instance": "compute-1/meminfo",
     "gid": "0",
-    "flags": "CL",
+    "flags": "CL   ",
     "duration": "0.000155",
     "data_sz": "432",
+    "heap_sz": "0",
+    "schema_digest": None,
     "schema": "meminfo"
   },
   "data": {
@@ -257,3 +262,30 @@ meminfo_expect = {
   }
 }
 assert(meminfo == meminfo_expect)
+
+# The outputs in ldms_ls_fixtures/ (NAME.txt) and their expected parse results
+# (NAME.json), recorded with the regex-alternation parser that the
+# per-section line classifier replaced
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "ldms_ls_fixtures")
+for name in sorted(os.listdir(fixtures)):
+    if not name.endswith(".txt"):
+        continue
+    path = os.path.join(fixtures, name)
+    with open(path) as f:
+        sets = parse_ldms_ls(f.read())
+    with open(path[:-4] + ".json") as f:
+        expect = json.load(f)
+    assert(sets == expect), name
+
+# malformed outputs
+for txt in [ "garbage\n",
+             "D u64 job_id 0\n",
+             out.replace("Total Sets", "Bogus Sets"),
+             out.replace("D u64        job_id", "D u64\n") ]:
+    try:
+        parse_ldms_ls(txt)
+        assert(0 == "RuntimeError expected")
+    except RuntimeError:
+        pass
+print("OK")
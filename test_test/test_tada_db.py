@@ -0,0 +1,554 @@
+#!/usr/bin/python3
+# Check the TADA_DB features on a scratch sqlite database. The tests are
+# written with `TADA_DB.ingest()`, like `tadad` does.
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+
+from TADA import TADA_DB, TADACache, TADAConnPool, TADATestModel, \
+                 TADAAssertionStatModel, Test, index_exists
+
+exec(open(os.getenv("PYTHONSTARTUP", "/dev/null")).read())
+
+wd = tempfile.mkdtemp(prefix = "test_tada_db.")
+db_path = os.path.join(wd, "tada_db.sqlite")
+
+def new_db():
+    if os.path.exists(db_path):
+        os.unlink(db_path)
+    return TADA_DB(db_driver = "sqlite", db_path = db_path)
+
+def test_msgs(test_id, start, results = "PF", test_name = "test",
+              commit_id = "c0", test_user = "alice", finish = True,
+              duration = 10):
+    """The messages of a test; `results` has the result of each assertion
+    (P: passed, F: failed, S: skipped)"""
+    status = { "P": "passed", "F": "failed", "S": "skipped" }
+    msgs = [ { "msg-type": "test-start", "test-id": test_id,
+               "test-suite": "SUITE", "test-type": "FVT",
+               "test-name": test_name, "test-user": test_user,
+               "commit-id": commit_id, "timestamp": start } ]
+    for i, r in enumerate(results, 1):
+        msgs.append({ "msg-type": "assert-status", "test-id": test_id,
+                      "assert-no": i, "assert-desc": "assertion {}".format(i),
+                      "assert-cond": "cond {}".format(i),
+                      "test-status": status[r], "timestamp": start + i })
+    if finish:
+        msgs.append({ "msg-type": "test-finish", "test-id": test_id,
+                      "timestamp": start + duration })
+    return msgs
+
+def test_ids(tests):
+    return sorted( t.test_id for t in tests )
+
+def count_rows(db, table):
+    cur = db.conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM {}".format(table))
+    return cur.fetchone()[0]
+
+# ---- purgeOldTests(): old runs, then the retention policy ----
+db = new_db()
+now = int(time.time())
+day = 86400
+msgs = test_msgs("a-1", now - 5*day, test_name = "a", commit_id = "c1") + \
+       test_msgs("a-2", now - 4*day, test_name = "a", commit_id = "c1") + \
+       test_msgs("b-1", now - 3*day, test_name = "b", commit_id = "c2") + \
+       test_msgs("b-2", now - 2*day, test_name = "b", commit_id = "c3") + \
+       test_msgs("c-1", now - 1*day, test_name = "c", commit_id = "c3") + \
+       test_msgs("c-2", now, test_name = "c", commit_id = "c3")
+db.ingest(msgs)
+# a-1 and c-1 are the old runs of a and c
+assert(db.purgeOldTests(compact = False, chunk = 1) == 2)
+assert(test_ids(db.findTests()) == [ "a-2", "b-1", "b-2", "c-2" ])
+assert(count_rows(db, "TADAAssertion") == 8)
+assert(db.purgeOldTests(keep_days = 3.5, compact = False) == 1)
+assert(test_ids(db.findTests()) == [ "b-1", "b-2", "c-2" ])
+# c3 is the most recently tested commit
+assert(db.purgeOldTests(keep_commits = 1) == 1)
+assert(test_ids(db.findTests()) == [ "b-2", "c-2" ])
+assert(count_rows(db, "TADAAssertion") == 4)
+db.close()
+
+# ---- ingest() with a TADACache: the same rows as without the cache ----
+def dump(db):
+    return [ (t.as_tuple(), [ a.as_tuple() for a in t.assertions ]) \
+             for t in db.iterTestsWithAssertions() ]
+
+msgs = test_msgs("t-1", 1000, "PFS") + test_msgs("t-2", 2000, "FF",
+                                                  finish = False)
+# assertion 1 of t-1 reported again, in a later batch
+again = dict(msgs[1], **{ "test-status": "failed", "timestamp": 1005 })
+db = new_db()
+db.ingest(msgs[:3])
+db.ingest(msgs[3:] + [ again ])
+expected = dump(db)
+db.close()
+db = new_db()
+cache = TADACache(max_tests = 1)
+db.ingest(msgs[:3], cache = cache)
+assert(len(cache) == 1 and cache.getTest("t-1") is not None)
+db.ingest(msgs[3:] + [ again ], cache = cache)
+# t-1 finished and is evicted, t-2 is still running
+assert(cache.getTest("t-1") is None and cache.getTest("t-2") is not None)
+assert(dump(db) == expected)
+t1 = db.findFirst(test_id = "t-1")
+assert(t1.test_status == "finished")
+assert([ a.assert_result for a in t1.assertions ] == [ "failed", "failed",
+                                                       "skipped" ])
+assert(db.findFirst(test_id = "t-2").test_status == "running")
+db.close()
+
+# ---- importJournals(): the spool of `Test`, and a results document ----
+spool = os.path.join(wd, "spool")
+t = Test("SUITE", "FVT", "spooled", commit_id = "c0", test_user = "alice",
+         spool_dir = spool)
+t.add_assertion(1, "one")
+t.add_assertion(2, "two")
+t.start()
+t.assert_test(1, True, "1 == 1")
+t.finish()
+spooled = t.test_id
+t = Test("SUITE", "FVT", "crashed", commit_id = "c0", test_user = "alice",
+         spool_dir = spool)
+t.add_assertion(1, "one")
+t.start()
+t.assert_test(1, False, "1 == 2") # no finish()
+crashed = t.test_id
+with open(os.path.join(spool, "doc.json"), "w") as f:
+    json.dump(test_msgs("doc-1", 1000, "PP", test_name = "doc"), f)
+with open(os.path.join(spool, "bad.json"), "w") as f:
+    f.write("[ {")
+db = new_db()
+for i in range(2): # importing again changes nothing
+    assert(db.importJournals([ spool ]) == 4)
+    t = db.findFirst(test_id = spooled)
+    assert(t.test_status == "finished" and t.test_user == "alice")
+    assert([ a.assert_result for a in t.assertions ] == [ "passed",
+                                                          "skipped" ])
+    t = db.findFirst(test_id = crashed)
+    assert(t.test_status == "incomplete")
+    assert([ a.assert_result for a in t.assertions ] == [ "failed" ])
+    t = db.findFirst(test_id = "doc-1")
+    assert(t.test_status == "finished")
+    assert(count_rows(db, "TADATest") == 3)
+    assert(count_rows(db, "TADAAssertion") == 5)
+    # the rollup counts each run once
+    stat = TADAAssertionStatModel.find_first(db.conn, test_name = "spooled",
+                                             assert_id = "1")
+    assert(stat.run_count == 1 and stat.pass_count == 1)
+# the malformed messages are skipped, the rest of the batch is imported
+bad_dir = os.path.join(wd, "bad_spool")
+os.makedirs(bad_dir)
+msgs = test_msgs("bad-1", 1000, "PF", test_name = "bad")
+msgs[1]["timestamp"] = "now"
+with open(os.path.join(bad_dir, "bad-0.jsonl"), "w") as f:
+    f.write(json.dumps({ "msg-type": "test-start", "test-id": "bad-0",
+                         "timestamp": 1000 }) + "\n")
+    f.write("5\n")
+with open(os.path.join(bad_dir, "bad-1.jsonl"), "w") as f:
+    f.write("".join( json.dumps(m) + "\n" for m in msgs ))
+msgs = test_msgs("bad-2", 1000, "P", test_name = "bad2")
+for m in msgs:
+    del m["test-id"]
+with open(os.path.join(bad_dir, "bad-2.json"), "w") as f:
+    json.dump(msgs, f)
+assert(db.importJournals([ bad_dir ], batch_max = 100) == 3)
+assert(db.findFirst(test_id = "bad-0") is None)
+t = db.findFirst(test_id = "bad-1")
+assert(t.test_status == "finished" and t.test_name == "bad")
+assert([ a.assert_result for a in t.assertions ] == [ "failed" ])
+assert(count_rows(db, "TADATest") == 4)
+db.close()
+
+# ---- metrics: findMetrics() and metricTrend() ----
+def metric(test_id, no, name, value, unit = "ops/s", tags = None):
+    return { "msg-type": "metric", "test-id": test_id, "metric-no": no,
+             "metric-name": name, "metric-value": value, "metric-unit": unit,
+             "metric-tags": tags, "timestamp": 1000.5 + no }
+
+db = new_db()
+db.ingest(test_msgs("m-1", 1000, commit_id = "c1") + \
+          test_msgs("m-2", 2000, commit_id = "c1") + \
+          test_msgs("m-3", 3000, commit_id = "c2") + [
+          metric("m-1", 0, "rate", 10, tags = { "xprt": "sock" }),
+          metric("m-1", 1, "lat", 0.5, unit = "s"),
+          metric("m-2", 0, "rate", 20),
+          metric("m-3", 0, "rate", 40) ])
+res = db.findMetrics("rate")
+assert([ (t.test_id, [ m.metric_value for m in ms ]) for t, ms in res ] == [
+            ("m-1", [ 10.0 ]), ("m-2", [ 20.0 ]), ("m-3", [ 40.0 ]) ])
+t, ms = db.findMetrics(commit_id = "c1")[0]
+assert([ (m.metric_name, m.metric_unit) for m in ms ] == [ ("rate", "ops/s"),
+                                                          ("lat", "s") ])
+assert(ms[0].tags == { "xprt": "sock" } and ms[1].tags == {})
+assert([ m.metric_name for m in db.findFirst(test_id = "m-1").metrics ] == \
+       [ "rate", "lat" ])
+trend = db.metricTrend("rate")
+assert([ r[4:9] for r in trend ] == [ ("c1", 2, 15.0, 10.0, 20.0),
+                                      ("c2", 1, 40.0, 40.0, 40.0) ])
+db.close()
+
+# ---- phases and assertion timestamps of `Test` ----
+spool = os.path.join(wd, "phases")
+t = Test("SUITE", "FVT", "phases", commit_id = "c0", spool_dir = spool)
+t.add_assertion(1, "one")
+t.start()
+with t.phase("setup"):
+    with t.phase("daemons"):
+        time.sleep(0.01)
+try:
+    with t.phase("run"):
+        t.assert_test(1, True, "1 == 1")
+        raise RuntimeError("stop")
+except RuntimeError:
+    pass
+t.finish()
+db = new_db()
+db.importJournals([ spool ])
+test = db.findFirst(test_id = t.test_id)
+assert([ (p.phase_no, p.phase_name, p.phase_parent, p.phase_status) \
+         for p in test.phases ] == [ (0, "setup", None, "ok"),
+                                     (1, "daemons", 0, "ok"),
+                                     (2, "run", None, "error") ])
+setup, daemons, run = test.phases
+assert(setup.duration >= daemons.duration >= 0.01)
+a = test.assertions[0]
+assert(run.phase_begin <= a.assert_ts <= run.phase_end)
+db.close()
+
+# ---- migrations: upgrade a database of the original schema ----
+if os.path.exists(db_path):
+    os.unlink(db_path)
+conn = sqlite3.connect(db_path)
+conn.execute("CREATE TABLE TADATest (test_id VARCHAR(64), test_suite TEXT,"
+             " test_type TEXT, test_name TEXT, test_user TEXT, commit_id TEXT,"
+             " test_desc TEXT, test_start INTEGER, test_finish INTEGER,"
+             " PRIMARY KEY(test_id))")
+conn.execute("CREATE TABLE TADAAssertion (test_id VARCHAR(64),"
+             " assert_id VARCHAR(64), assert_result TEXT, assert_cond TEXT,"
+             " assert_desc TEXT, PRIMARY KEY(test_id, assert_id))")
+for i, res in enumerate([ "passed", "failed", "passed" ]):
+    conn.execute("INSERT INTO TADATest VALUES (?,?,?,?,?,?,?,?,?)",
+                 ("old-{}".format(i), "SUITE", "FVT", "old", "alice", "c0",
+                  "old", 1000 + i, 1010 + i))
+    conn.execute("INSERT INTO TADAAssertion VALUES (?,?,?,?,?)",
+                 ("old-{}".format(i), "1", res, "cond", "desc"))
+conn.commit()
+conn.close()
+for i in range(2): # opening the upgraded database again changes nothing
+    db = TADA_DB(db_driver = "sqlite", db_path = db_path)
+    assert(db.schema_version() == len(TADA_DB.MIGRATIONS))
+    assert(count_rows(db, "TADASchema") == len(TADA_DB.MIGRATIONS))
+    assert(index_exists(db.conn, "TADATest", "TADATest_run"))
+    assert(index_exists(db.conn, "TADAMetric", "TADAMetric_name"))
+    t = db.findFirst(test_id = "old-1")
+    assert(t.test_status is None and t.assertions[0].assert_ts is None)
+    # the rollup is built from the existing history
+    stat = TADAAssertionStatModel.find_first(db.conn, test_name = "old")
+    assert(stat.last_results == "PFP" and stat.flip_count == 2)
+    db.close()
+
+# ---- SQLModel.bulk_upsert() and bulk_update() ----
+db = new_db()
+TADATestModel.bulk_upsert(db.conn, [
+    { "test_id": "u-1", "test_name": "one", "test_status": "running" },
+    [ "u-2", "SUITE", "FVT", "two" ], # the trailing columns are left blank
+])
+TADATestModel.bulk_upsert(db.conn, [
+    # only the given columns of the existing row are updated
+    { "test_id": "u-1", "test_status": "finished" },
+    { "test_id": "u-3", "test_name": "three" },
+])
+assert(sorted( (t.test_id, t.test_name, t.test_suite, t.test_status) \
+               for t in TADATestModel.find(db.conn) ) == [
+            ("u-1", "one", None, "finished"), ("u-2", "two", "SUITE", None),
+            ("u-3", "three", None, None) ])
+t = db.findFirst(test_id = "u-2")
+t.test_user = "bob"
+TADATestModel.bulk_update(db.conn, [ t,
+    { "test_id": "u-3", "test_user": "carol" },
+    { "test_id": "u-4", "test_user": "dave" }, # not in the table, ignored
+])
+assert(sorted( (t.test_id, t.test_name, t.test_user) \
+               for t in TADATestModel.find(db.conn) ) == [ ("u-1", "one", None),
+            ("u-2", "two", "bob"), ("u-3", "three", "carol") ])
+db.close()
+
+# ---- SQLModel.iter(): streamed in batches ----
+db = new_db()
+db.ingest(sum([ test_msgs("i-{}".format(i), 1000 + i, test_user = u) \
+                for i, u in enumerate("abababa") ], []))
+it = TADATestModel.iter(db.conn, order_by = "test_start", batch_size = 2,
+                        test_user = "a")
+assert(next(it).test_id == "i-0")
+assert([ t.test_id for t in it ] == [ "i-2", "i-4", "i-6" ])
+it = TADATestModel.iter(db.conn, order_by = "test_start DESC", batch_size = 3)
+assert([ next(it).test_id for i in range(2) ] == [ "i-6", "i-5" ])
+it.close() # stopped early, the cursor is closed
+assert([ t.test_id for t in db.iterTests(test_user = "b") ] == [ "i-1", "i-3",
+                                                                 "i-5" ])
+db.close()
+
+# ---- findTests(latest = True): the latest run of each test ----
+db = new_db()
+db.ingest(test_msgs("l-1", 1000, test_name = "x") + \
+          test_msgs("l-2", 3000, test_name = "x") + \
+          test_msgs("l-3", 2000, test_name = "x", test_user = "bob") + \
+          test_msgs("l-4", 1500, test_name = "x", commit_id = "c1") + \
+          test_msgs("l-5", 500, test_name = "y") + \
+          # test-start lost, never the latest
+          [ { "msg-type": "test-finish", "test-id": "l-6", "timestamp": 9000 } ])
+assert(test_ids(db.findTests(latest = True)) == [ "l-2", "l-3", "l-4", "l-5" ])
+assert(test_ids(db.findTests(latest = True, test_user = "alice",
+                             commit_id = "c0")) == [ "l-2", "l-5" ])
+assert(test_ids(db.findTests(latest = True, test_name = "x",
+                             test_user = "bob")) == [ "l-3" ])
+assert([ t.test_id for t in db.iterTests(latest = True) ] == [ "l-2", "l-4",
+                                                               "l-3", "l-5" ])
+assert(len(db.findTests()) == 6)
+db.close()
+
+# ---- iterTestsWithAssertions(): assertions preloaded per chunk ----
+def phase(test_id):
+    return [ { "msg-type": "phase-begin", "test-id": test_id, "phase-no": 0,
+               "phase-name": "setup", "timestamp": 1000.5 },
+             { "msg-type": "phase-end", "test-id": test_id, "phase-no": 0,
+               "phase-status": "ok", "timestamp": 1001.5 } ]
+
+db = new_db()
+db.ingest(sum([ test_msgs("e-{}".format(i), 1000 + i, "P" * 11) + \
+                phase("e-{}".format(i)) for i in range(5) ], []) + \
+          test_msgs("e-5", 2000, ""))
+tests = list(db.iterTestsWithAssertions(chunk = 2))
+assert([ t.test_id for t in tests ] == [ "e-{}".format(i) for i in range(6) ])
+assert(all( t._assertions is not None and t._phases is not None \
+            for t in tests ))
+# sorted by numeric assert_id, "10" after "9"
+assert([ a.assert_id for a in tests[0].assertions ] == \
+       [ str(i) for i in range(1, 12) ])
+assert([ p.phase_name for p in tests[4].phases ] == [ "setup" ])
+assert(tests[5].assertions == [] and tests[5].phases == [])
+lazy = db.findFirst(test_id = "e-3")
+assert(sorted( a.as_tuple() for a in lazy.assertions ) == \
+       sorted( a.as_tuple() for a in tests[3].assertions ))
+assert(len(db.findTestsWithAssertions(latest = True)) == 1)
+db.close()
+
+# ---- TADAConnPool: bounded connections, reused by the threads ----
+new_db().close()
+pool = TADAConnPool(db_driver = "sqlite", db_path = db_path, max_conns = 2)
+c1 = pool.acquire()
+c2 = pool.acquire()
+try:
+    pool.acquire(timeout = 0.1)
+    assert(0 == "acquire() did not time out")
+except TimeoutError:
+    pass
+assert(c1.execute("PRAGMA journal_mode").fetchone()[0] == "wal")
+c1.execute("INSERT INTO TADATest (test_id) VALUES ('p-1')")
+pool.release(c1) # not committed, rolled back
+pool.release(c2, discard = True)
+def writer(i):
+    db = TADA_DB(pool = pool)
+    db.ingest(test_msgs("p-{}".format(i), 1000 + i))
+    db.close()
+threads = [ threading.Thread(target = writer, args = (i, )) \
+            for i in range(2, 10) ]
+for th in threads:
+    th.start()
+for th in threads:
+    th.join()
+assert(pool._count <= 2)
+with pool.connection() as conn:
+    assert(sorted( r[0] for r in conn.execute("SELECT test_id FROM TADATest") ) \
+           == [ "p-{}".format(i) for i in range(2, 10) ])
+pool.close()
+assert(pool._count == 0)
+
+# ---- archiveTests(): round-trip through the archive ----
+if os.path.exists(db_path):
+    os.unlink(db_path)
+archive_dir = os.path.join(wd, "archive")
+db = TADA_DB(db_driver = "sqlite", db_path = db_path,
+             archive_dir = archive_dir)
+jan, feb, mar = 1704067200, 1706745600, 1709251200 # 2024-01/02/03-01 UTC
+db.ingest(test_msgs("r-1", jan, "PF", test_name = "x") + \
+          test_msgs("r-2", feb, "SP", test_name = "x", commit_id = "c1") + \
+          test_msgs("r-3", feb + 1, "F", test_name = "y") + \
+          test_msgs("r-4", mar, "PP", test_name = "x") + \
+          [ metric("r-2", 0, "rate", 10), metric("r-2", 1, "rate", 11) ] + \
+          phase("r-1"))
+before = [ (t.as_tuple(), [ a.as_tuple() for a in t.assertions ],
+            [ p.as_tuple() for p in t.phases ]) for t in db.findTests() ]
+assert(db.archiveTests(mar, chunk = 2) == 3)
+assert(test_ids(db.findTests()) == [ "r-4" ])
+assert(count_rows(db, "TADAAssertion") == 2)
+assert(count_rows(db, "TADAMetric") == 0)
+assert(db.archive.partitions() == [ "2024-01", "2024-02" ])
+idx = db.archive.loadIndex("2024-02")
+assert(idx["tests"] == 2 and idx["test_name"] == [ "x", "y" ])
+tests = list(db.iterTestsWithAssertions())
+after = [ (t.as_tuple(), [ a.as_tuple() for a in t.assertions ],
+           [ p.as_tuple() for p in t.phases ]) for t in tests ]
+assert(sorted(after) == sorted(before))
+r2 = [ t for t in tests if t.test_id == "r-2" ][0]
+assert([ m.metric_value for m in r2.metrics ] == [ 10.0, 11.0 ])
+# the database run is the latest, the archived runs of the other tests follow
+assert([ t.test_id for t in db.iterTestsWithAssertions(latest = True) ] == \
+       [ "r-4", "r-2", "r-3" ])
+assert([ t.test_id for t in db.iterTestsWithAssertions(test_name = "y") ] == \
+       [ "r-3" ])
+# archived again (e.g. crashed before the delete), still one copy
+db.archive.add([ t for t in tests if t.test_id == "r-1" ])
+assert(len(list(db.archive.iterTests(test_name = "x"))) == 2)
+db.close()
+
+# ---- diffCommits(): the latest results of two commits ----
+db = new_db()
+db.ingest(test_msgs("d-1", 1000, "PPFP", test_name = "x", commit_id = "base") + \
+          test_msgs("d-2", 1100, "PFPS", test_name = "x", commit_id = "head") + \
+          # a re-run of x on base: only the latest run counts
+          test_msgs("d-0", 900, "FFFF", test_name = "x", commit_id = "base") + \
+          test_msgs("d-3", 2000, "PP", test_name = "y", commit_id = "base",
+                    duration = 10) + \
+          test_msgs("d-4", 2100, "P", test_name = "y", commit_id = "head",
+                    duration = 30) + \
+          test_msgs("d-5", 3000, "P", test_name = "z", commit_id = "head"))
+def entry(e):
+    # (test_name, assert_id, base_result, head_result)
+    return (e[2], e[4]) + e[6:]
+
+d = db.diffCommits("base", "head")
+assert([ entry(e) for e in d["failing"] ] == [ ("x", "2", "passed", "failed") ])
+assert([ entry(e) for e in d["passing"] ] == [ ("x", "3", "failed", "passed") ])
+assert([ entry(e) for e in d["skipped"] ] == [ ("x", "4", "passed", "skipped") ])
+assert([ entry(e) for e in d["missing"] ] == [ ("y", "2", "passed", None) ])
+assert(d["failing"][0][5] == "assertion 2")
+assert(d["failing"][0][:4] == ("SUITE", "FVT", "x", "alice"))
+assert(d["durations"] == [ ("SUITE", "FVT", "y", "alice", 10, 30) ])
+# a change under `duration_min` seconds is not reported
+assert(db.diffCommits("base", "head", duration_min = 30)["durations"] == [])
+d = db.diffCommits("head", "head")
+assert(all( d[k] == [] for k in d ))
+# the runs of another user are compared on their own, and not at all when
+# filtered out
+db.ingest(test_msgs("d-6", 4000, "FPFP", test_name = "x", commit_id = "base",
+                    test_user = "bob") + \
+          test_msgs("d-7", 4100, "FPFF", test_name = "x", commit_id = "head",
+                    test_user = "bob"))
+d = db.diffCommits("base", "head")
+assert([ (e[3],) + entry(e) for e in d["failing"] ] == \
+       [ ("alice", "x", "2", "passed", "failed"),
+         ("bob", "x", "4", "passed", "failed") ])
+assert([ (e[3],) + entry(e) for e in d["passing"] ] == \
+       [ ("alice", "x", "3", "failed", "passed") ])
+d = db.diffCommits("base", "head", test_user = "bob")
+assert([ entry(e) for e in d["failing"] ] == [ ("x", "4", "passed", "failed") ])
+assert(d["passing"] == d["skipped"] == d["missing"] == [])
+db.close()
+
+# ---- the assertion rollup: incremental == rebuilt, and flakyAssertions() ----
+def rollup(db):
+    return sorted( o.as_tuple() for o in TADAAssertionStatModel.iter(db.conn) )
+
+db = new_db()
+runs = [ "PPP", "PFP", "PPS", "PFF", "PPP", "PFP" ]
+cache = TADACache()
+for i, res in enumerate(runs):
+    msgs = test_msgs("f-{}".format(i), 1000 * i, res, test_name = "x")
+    # the first assertion of each run is reported again in the next batch
+    db.ingest(msgs[:-2], cache = cache if i % 2 else None)
+    db.ingest(msgs[1:2] + msgs[-2:], cache = cache if i % 2 else None)
+db.ingest(test_msgs("f-y", 500, "F", test_name = "y"))
+incremental = rollup(db)
+assert(db.rebuildAssertionStats() == 4)
+assert(rollup(db) == incremental)
+assert(db.rebuildAssertionStats([ ("SUITE", "x") ]) == 3)
+assert(rollup(db) == incremental)
+stat = TADAAssertionStatModel.find_first(db.conn, test_name = "x",
+                                         assert_id = "2")
+assert(stat.last_results == "PFPFPF" and stat.flip_count == 5)
+assert((stat.run_count, stat.pass_count, stat.fail_count) == (6, 3, 3))
+assert(stat.last_flip == 5000 and stat.last_test_id == "f-5")
+stat = TADAAssertionStatModel.find_first(db.conn, test_name = "x",
+                                         assert_id = "3")
+# a skipped run is not a flip
+assert(stat.last_results == "PPSFPP" and stat.flip_count == 2)
+flaky = db.flakyAssertions(window = 20, min_flips = 2)
+assert([ (o.assert_id, flips) for o, flips in flaky ] == [ ("2", 5),
+                                                           ("3", 2) ])
+flaky = db.flakyAssertions(window = 3, min_flips = 1, test_name = "x")
+assert([ (o.assert_id, flips) for o, flips in flaky ] == [ ("2", 2),
+                                                           ("3", 1) ])
+db.close()
+
+# the runs are folded once, when they complete, in the order of the start
+# time: B (bob) starts after A (alice) but completes first
+for cache in [ None, TADACache() ]:
+    db = new_db()
+    db.ingest(test_msgs("r-0", 100, "PP", test_name = "x", test_user = "bob"))
+    a = test_msgs("r-a", 1000, "PF", test_name = "x")
+    b = test_msgs("r-b", 2000, "FP", test_name = "x", test_user = "bob",
+                  commit_id = "c1")
+    for batch in [ a[:2], b[:2], a[2:3], b[2:] ]:
+        db.ingest(batch, cache = cache)
+    assert(TADAAssertionStatModel.find_first(db.conn, test_name = "x",
+                                             assert_id = "1") \
+            .last_results == "PF")
+    db.ingest(a[3:], cache = cache)
+    db.ingest(test_msgs("r-c", 3000, "PP", test_name = "x"), cache = cache)
+    # a running test is not counted yet
+    db.ingest(test_msgs("r-d", 4000, "FF", test_name = "x")[:-1], cache = cache)
+    incremental = rollup(db)
+    stat = TADAAssertionStatModel.find_first(db.conn, test_name = "x",
+                                             assert_id = "1")
+    assert(stat.last_results == "PPFP" and stat.run_count == 4)
+    assert((stat.flip_count, stat.last_flip) == (2, 3000))
+    assert(stat.last_test_id == "r-c" and stat.last_start == 3000)
+    stat = TADAAssertionStatModel.find_first(db.conn, test_name = "x",
+                                             assert_id = "2")
+    assert(stat.last_results == "PFPP" and stat.flip_count == 2)
+    assert(db.rebuildAssertionStats() == 2)
+    assert(rollup(db) == incremental)
+    db.close()
+
+# ---- durationTrend() and durationSlowdowns(): median/MAD baseline ----
+db = new_db()
+msgs = list()
+durs = { "slow":   [ 100, 102, 98, 101, 99, 150 ],
+         "steady": [ 100, 130, 70, 120, 80, 125 ],
+         "new":    [ None, None, None, None, 100, 200 ] }
+for name, lst in durs.items():
+    for i, dur in enumerate(lst):
+        if dur is not None:
+            msgs += test_msgs("{}-{}".format(name, i), 1000 * i, "P",
+                              test_name = name, commit_id = "c{}".format(i),
+                              duration = dur)
+# two runs on c0 averaged, an unfinished run not counted
+msgs += test_msgs("slow-0b", 10, "P", test_name = "slow", commit_id = "c0",
+                  duration = 90)
+msgs += test_msgs("slow-0c", 20, "P", test_name = "slow", commit_id = "c0",
+                  finish = False)
+db.ingest(msgs)
+trend = db.durationTrend(test_name = "slow")
+assert([ (r[2], r[3], float(r[4])) for r in trend ][:2] == [ ("c0", 2, 95.0),
+                                                             ("c1", 1, 102.0) ])
+assert(len(trend) == 6)
+res = db.durationSlowdowns()
+assert(len(res) == 1)
+suite, name, commit, dur, med, mad, n = res[0]
+assert((name, commit, dur, med, n) == ("slow", "c5", 150.0, 99.0, 5))
+assert(abs(mad - 2 * 1.4826) < 1e-9) # deviations 4, 3, 1, 2, 0
+# c4 is not slower than its baseline, "new" has too few baseline commits
+assert(db.durationSlowdowns(commit_id = "c4") == [])
+assert(db.durationSlowdowns(min_runs = 1)[0][1] == "new")
+# the slowdown must also exceed `min_delta` seconds
+assert(db.durationSlowdowns(min_delta = 60) == [])
+db.close()
+
+print("OK")
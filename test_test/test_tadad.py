@@ -0,0 +1,373 @@
+#!/usr/bin/python3
+# Check the message handling of `tadad`. A `tadad` is started on a scratch
+# sqlite database, then fed with good and malformed messages over the framed
+# tcp transport. TADAD_PORT environment variable overrides the base port
+# (udp; tcp is +1, the feed is +2).
+
+import gc
+import os
+import sys
+import json
+import time
+import socket
+import weakref
+import tempfile
+import subprocess
+
+import TADA
+from TADA import TADA_DB, frame
+
+exec(open(os.getenv("PYTHONSTARTUP", "/dev/null")).read())
+
+TADAD = os.path.join(os.path.dirname(os.path.realpath(TADA.__file__)), "tadad")
+UDP_PORT = int(os.getenv("TADAD_PORT", "19962"))
+TCP_PORT = UDP_PORT + 1
+FEED_PORT = UDP_PORT + 2
+
+wd = tempfile.mkdtemp(prefix = "test_tadad.")
+db_path = os.path.join(wd, "tada_db.sqlite")
+log_path = os.path.join(wd, "tadad.log")
+drop_dir = os.path.join(wd, "drop")
+
+tadad = subprocess.Popen([ sys.executable, TADAD, "-F",
+                           "-p", str(UDP_PORT), "--tcp-port", str(TCP_PORT),
+                           "--feed-port", str(FEED_PORT),
+                           "-l", log_path, "--db-path", db_path,
+                           "--drop-dir", drop_dir, "--inflight-ttl", "3",
+                           "--batch-ms", "20" ], cwd = wd)
+
+def server_stats(timeout = 5.0):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    t1 = time.time() + timeout
+    try:
+        while True:
+            sock.sendto(b'{"msg-type": "server-stats"}',
+                        ("localhost", UDP_PORT))
+            try:
+                data, _ = sock.recvfrom(128*1024)
+                return json.loads(data)
+            except socket.timeout:
+                if time.time() > t1:
+                    raise
+    finally:
+        sock.close()
+
+def send(*msgs):
+    """Send each of `msgs` (dict, or bytes as-is) in a frame over tcp"""
+    with socket.create_connection(("localhost", TCP_PORT)) as sock:
+        for m in msgs:
+            if type(m) != bytes:
+                m = json.dumps(m).encode()
+            sock.sendall(frame(m))
+
+def settle():
+    """Wait until `tadad` has written all the messages received so far"""
+    for i in range(100):
+        r = server_stats()
+        if r["queue_depth"] == 0:
+            break
+        time.sleep(0.05)
+    time.sleep(0.2) # the last batch in the writer
+    return server_stats()
+
+def test_msgs(test_id, test_user = "alice", test_suite = "TADAD"):
+    """The messages of a finished test with 2 assertions"""
+    msgs = [
+        { "msg-type": "test-start", "test-suite": test_suite,
+          "test-type": "FVT", "test-name": "tadad_test",
+          "test-user": test_user, "commit-id": "c0", "timestamp": 1000 },
+        { "msg-type": "assert-status", "assert-no": 1,
+          "assert-desc": "one", "assert-cond": "1 == 1",
+          "test-status": "passed", "timestamp": 1001.5 },
+        { "msg-type": "assert-status", "assert-no": 2,
+          "assert-desc": "two", "assert-cond": "1 == 2",
+          "test-status": "failed", "timestamp": 1002.5 },
+        { "msg-type": "test-finish", "timestamp": 1003 },
+    ]
+    for seq, m in enumerate(msgs):
+        m["test-id"] = test_id
+        m["seq"] = seq
+    return msgs
+
+def drop(name, msgs):
+    """Move a results document into the drop directory"""
+    tmp = os.path.join(drop_dir, name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(msgs, f)
+    os.rename(tmp, os.path.join(drop_dir, name + ".json"))
+
+def stored(test_id):
+    db = TADA_DB(db_driver = "sqlite", db_path = db_path)
+    try:
+        t = db.findFirst(test_id = test_id)
+        if t is None:
+            return None
+        return (t.test_status, t.test_user,
+                [ a.assert_result for a in t.assertions ])
+    finally:
+        db.close()
+
+try:
+    s0 = server_stats()
+
+    # a batch with elements that are not messages, and a batch without a list
+    good = test_msgs("batch-1")
+    send({ "msg-type": "batch", "msgs": [ 1, "x", None ] + good },
+         { "msg-type": "batch", "msgs": 5 },
+         b"[1, 2",
+         b"not json")
+    s1 = settle()
+    assert(tadad.poll() is None)
+    assert(s1["parse_errors"] - s0["parse_errors"] == 6)
+    assert(stored("batch-1") == ("finished", "alice", [ "passed", "failed" ]))
+
+    # messages with a bad `seq` or `test-id` are dropped
+    msgs = test_msgs("seq-1")
+    msgs[1]["seq"] = "1"
+    msgs[2]["seq"] = [ 2 ]
+    send(*msgs, { "msg-type": "test-finish", "test-id": [ "seq-1" ],
+                  "timestamp": 1003 })
+    s2 = settle()
+    assert(tadad.poll() is None)
+    assert(s2["parse_errors"] - s1["parse_errors"] == 3)
+    assert(stored("seq-1") == ("finished", "alice", []))
+
+    # malformed messages are dropped before they reach the writer, and do not
+    # stop the writer from storing the good ones
+    msgs = test_msgs("fields-1")
+    msgs[2]["assert-desc"] = { "not": "text" }
+    send({ "msg-type": "test-start", "test-id": "fields-0", "timestamp": 1 },
+         { "msg-type": "metric", "test-id": "fields-1", "metric-no": 0,
+           "metric-name": "x", "metric-value": "fast" },
+         *msgs)
+    s3 = settle()
+    assert(s3["parse_errors"] - s2["parse_errors"] == 3)
+    assert(s3["db_errors"] == 0)
+    assert(stored("fields-0") == None)
+    assert(stored("fields-1") == ("finished", "alice", [ "passed" ]))
+
+    # the feed filtered by test-user gets all the events of the user's tests
+    feed = socket.create_connection(("localhost", FEED_PORT))
+    feed.sendall(b'{"test-user": "bob"}\n')
+    settle() # the subscription is processed
+    send(*test_msgs("feed-alice", test_user = "alice"))
+    send(*test_msgs("feed-bob", test_user = "bob"))
+    settle()
+    feed.settimeout(2)
+    events = list()
+    f = feed.makefile("rb")
+    while len(events) < 4:
+        events.append(json.loads(f.readline()))
+    feed.close()
+    assert([ e["msg-type"] for e in events ] == [ "test-start",
+                "assert-status", "assert-status", "test-finish" ])
+    assert(all( e["test-id"] == "feed-bob" and e["test-user"] == "bob" \
+                and e["test-name"] == "tadad_test" for e in events ))
+
+    # results documents: over the stream, and in the drop directory
+    send(json.dumps(test_msgs("doc-1")).encode())
+    bad = test_msgs("doc-bad")
+    bad[1]["assert-no"] = None
+    drop("bad", bad)
+    drop("good", test_msgs("doc-2"))
+    time.sleep(1.5) # the drop directory is checked every second
+    settle()
+    assert(sorted(os.listdir(drop_dir)) == [ "bad.json.failed" ])
+    assert(stored("doc-1") == ("finished", "alice", [ "passed", "failed" ]))
+    assert(stored("doc-2") == ("finished", "alice", [ "passed", "failed" ]))
+    assert(stored("doc-bad") == None)
+
+    # a document uploaded to a port without a stream listener goes over udp
+    from LDMS_Test import create_suite_from_C_test_results
+    addr = "localhost:{}".format(UDP_PORT)
+    txt = json.dumps(test_msgs("doc-udp"))
+    rc = create_suite_from_C_test_results(txt, addr, transport = "tcp")
+    assert(rc == -1) # assertion 2 failed
+    # a crashed C test fails: an empty document, or a document cut short
+    assert(create_suite_from_C_test_results("[", addr) == -1)
+    msgs = test_msgs("doc-crash")
+    msgs[2]["test-status"] = "passed"
+    txt = json.dumps(msgs[:3])[:-1] + ","
+    assert(create_suite_from_C_test_results(txt, addr) == -1)
+    assert(create_suite_from_C_test_results(json.dumps(msgs), addr) == 0)
+    settle()
+    assert(stored("doc-udp") == ("finished", "alice", [ "passed", "failed" ]))
+    assert(stored("doc-crash")[:2] == ("finished", "alice"))
+    TADA.SPOOL_DIR = os.path.join(wd, "spool")
+    try:
+        create_suite_from_C_test_results("[", addr)
+        assert(0 == "an empty document was spooled")
+    except ValueError:
+        pass
+    finally:
+        TADA.SPOOL_DIR = None
+    # the stream upload times out instead of hanging on a blackholed tadad
+    blackhole = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    blackhole.bind(("localhost", 0))
+    blackhole.listen(0)
+    t0 = time.time()
+    try:
+        # the frame is larger than the socket buffers, and never read
+        TADA.upload_results(b"[" + b" " * 64*1024*1024 + b"]",
+                "localhost:{}".format(blackhole.getsockname()[1]),
+                timeout = 0.5)
+        assert(0 == "upload_results() did not time out")
+    except socket.timeout:
+        pass
+    assert(time.time() - t0 < 5)
+    blackhole.close()
+
+    # a buffered `Test` packs its messages into a batch datagram
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(("localhost", 0))
+    rx.settimeout(2)
+    for port in [ rx.getsockname()[1], UDP_PORT ]:
+        t = TADA.Test("TADAD", "FVT", "buffered-{}".format(port),
+                      tada_addr = "localhost:{}".format(port), buffered = True,
+                      flush_interval = 60)
+        t.add_assertion(1, "one")
+        t.add_assertion(2, "two")
+        t.start()
+        t.assert_test(1, True, "1 == 1")
+        assert(t.finish() == -1) # assertion 2 skipped
+    # the finished Test is not held by the exit handler
+    test_id, ref = t.test_id, weakref.ref(t)
+    del t
+    gc.collect()
+    assert(ref() is None)
+    data, _ = rx.recvfrom(65536)
+    rx.close()
+    batch = json.loads(data)
+    assert(batch["msg-type"] == "batch")
+    assert([ m["msg-type"] for m in batch["msgs"] ] == [ "test-start",
+                "assert-status", "assert-status", "test-finish" ])
+    assert([ m["seq"] for m in batch["msgs"] ] == [ 0, 1, 2, 3 ])
+    settle()
+    assert(stored(test_id)[2] == [ "passed", "skipped" ])
+
+    # a `Test` over tcp re-sends its messages after reconnecting, and tadad
+    # drops the duplicates by seq
+    s4 = settle()
+    t = TADA.Test("TADAD", "FVT", "stream",
+                  tada_addr = "localhost:{}".format(TCP_PORT),
+                  transport = "tcp")
+    t.add_assertion(1, "one")
+    t.add_assertion(2, "two")
+    t.start()
+    t.assert_test(1, True, "1 == 1")
+    t._close() # the connection is lost
+    t.assert_test(2, True, "2 == 2")
+    assert(t.finish() == 0)
+    s5 = settle()
+    assert(s5["duplicates"] - s4["duplicates"] == 2)
+    assert(stored(t.test_id) == ("finished", TADA.LOGIN,
+                                 [ "passed", "passed" ]))
+    # the frames split across segments, and a frame over MAX_FRAME
+    data = b"".join( frame(json.dumps(m).encode()) \
+                     for m in test_msgs("frames-1") )
+    with socket.create_connection(("localhost", TCP_PORT)) as sock:
+        for i in range(0, len(data), 7):
+            sock.sendall(data[i:i+7])
+            time.sleep(0.001)
+    with socket.create_connection(("localhost", TCP_PORT)) as sock:
+        sock.sendall(TADA.FRAME_HDR.pack(TADA.MAX_FRAME + 1))
+        sock.settimeout(2)
+        assert(sock.recv(1) == b"") # closed by tadad
+    settle()
+    assert(tadad.poll() is None)
+    assert(stored("frames-1") == ("finished", "alice", [ "passed", "failed" ]))
+
+    # an abandoned test is marked incomplete after --inflight-ttl, keeping
+    # the results received so far
+    s6 = settle()
+    send(*test_msgs("ttl-1")[:2])
+    s7 = settle()
+    assert(s7["inflight"] - s6["inflight"] == 1)
+    assert(stored("ttl-1") == ("running", "alice", [ "passed" ]))
+    for i in range(100):
+        if stored("ttl-1")[0] == "incomplete":
+            break
+        time.sleep(0.1)
+    s8 = settle()
+    assert(stored("ttl-1") == ("incomplete", "alice", [ "passed" ]))
+    assert(s8["incomplete"] - s7["incomplete"] == 1)
+    assert(s8["inflight"] == s6["inflight"])
+
+    # the server statistics count the messages and the anomalies
+    msgs = test_msgs("stats-1")
+    send({ "msg-type": "assert-status", "test-id": "stats-0", "assert-no": 1,
+           "assert-desc": "one", "assert-cond": "1 == 1",
+           "test-status": "passed" }, # without test-start
+         *(msgs[:2] + msgs[1:])) # assertion 1 twice
+    s9 = settle()
+    assert(s9["orphans"] - s8["orphans"] == 1)
+    assert(s9["duplicates"] - s8["duplicates"] == 1)
+    assert(s9["msgs"]["test-start"] - s8["msgs"]["test-start"] == 1)
+    assert(s9["msgs"]["assert-status"] - s8["msgs"]["assert-status"] == 4)
+    assert(s9["db_msgs"] - s8["db_msgs"] == 5)
+    assert(s9["db_commit"]["count"] > s8["db_commit"]["count"])
+    assert(s9["queue_depth"] == 0 and s9["queue_drops"] == 0)
+    out = subprocess.check_output([ sys.executable,
+                os.path.join(os.path.dirname(TADAD), "tadaq"),
+                "--server-stats", "--tada-addr",
+                "localhost:{}".format(UDP_PORT) ], cwd = wd).decode()
+    assert("orphans: {}\n".format(s9["orphans"]) in out)
+    assert("db_commit: count: " in out)
+finally:
+    tadad.terminate()
+    tadad.wait()
+
+# The writer retries a failed batch message by message
+import logging
+import importlib.util
+from importlib.machinery import SourceFileLoader
+from TADA import TADAConnPool
+
+loader = SourceFileLoader("tadad", TADAD)
+tadad_mod = importlib.util.module_from_spec(
+                importlib.util.spec_from_loader("tadad", loader))
+loader.exec_module(tadad_mod)
+logging.basicConfig(filename = os.path.join(wd, "writer.log"),
+                    level = logging.INFO)
+tadad_mod.log = logging.getLogger("tadad")
+
+pool = TADAConnPool(db_driver = "sqlite", db_path = db_path, max_conns = 2)
+writer = tadad_mod.DBWriter(pool)
+bad = test_msgs("writer-0")[0]
+bad["timestamp"] = "not a time" # not checked, fails in the database writer
+for m in [ bad ] + test_msgs("writer-1"):
+    writer.put(("test", 0), m)
+writer.start()
+writer.stop()
+assert(tadad_mod.stats.db_errors == 1)
+assert(stored("writer-0") == None)
+assert(stored("writer-1") == ("finished", "alice", [ "passed", "failed" ]))
+
+# A results document that fails in the database does not take the following
+# documents down with it, and only that one is marked failed
+os.makedirs(drop_dir, exist_ok = True)
+writer = tadad_mod.DBWriter(pool)
+paths = list()
+for name, ts in [ ("writer-2", "not a time"), ("writer-3", 1000) ]:
+    msgs = test_msgs(name)
+    msgs[0]["timestamp"] = ts
+    path = os.path.join(drop_dir, name + ".json")
+    open(path, "w").close()
+    tadad_mod.dropped.add(path)
+    writer.put_results(("test", 0), msgs, path)
+    paths.append(path)
+writer.start()
+writer.stop()
+pool.close()
+assert(not tadad_mod.dropped)
+assert(not os.path.exists(paths[0]) and os.path.exists(paths[0] + ".failed"))
+assert(not os.path.exists(paths[1]))
+assert(stored("writer-2") == None)
+assert(stored("writer-3") == ("finished", "alice", [ "passed", "failed" ]))
+# the latency percentiles are rounded like the other stats
+h = tadad_mod.Histogram()
+h.add(0.1 + 0.2) # 0.30000000000000004
+r = h.as_dict()
+assert(r["p50_ms"] == 0.3 and r["p99_ms"] == 0.3 and r["max_ms"] == 0.3)
+print("OK")
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# Check the machine-readable outputs of `tadaq` (--format jsonl, csv and
+# junit) on a scratch sqlite database.
+
+import os
+import io
+import sys
+import csv
+import json
+import tempfile
+import subprocess
+import xml.etree.ElementTree as ET
+
+import TADA
+from TADA import TADA_DB
+
+exec(open(os.getenv("PYTHONSTARTUP", "/dev/null")).read())
+
+TADAQ = os.path.join(os.path.dirname(os.path.realpath(TADA.__file__)), "tadaq")
+
+wd = tempfile.mkdtemp(prefix = "test_tadaq.")
+db_path = os.path.join(wd, "tada_db.sqlite")
+
+def test_msgs(test_id, start, results, test_name, finish = True):
+    status = { "P": "passed", "F": "failed", "S": "skipped" }
+    msgs = [ { "msg-type": "test-start", "test-id": test_id,
+               "test-suite": "SUITE", "test-type": "FVT",
+               "test-name": test_name, "test-user": "alice",
+               "commit-id": "c0", "timestamp": start } ]
+    for i, r in enumerate(results, 1):
+        msgs.append({ "msg-type": "assert-status", "test-id": test_id,
+                      "assert-no": i, "assert-desc": 'a <"{}">, & b'.format(i),
+                      "assert-cond": "x == {}".format(i),
+                      "test-status": status[r], "timestamp": start + 2*i })
+    if finish:
+        msgs.append({ "msg-type": "test-finish", "test-id": test_id,
+                      "timestamp": start + 10 })
+    else:
+        msgs.append({ "msg-type": "test-incomplete", "test-id": test_id })
+    return msgs
+
+db = TADA_DB(db_driver = "sqlite", db_path = db_path)
+db.ingest(test_msgs("q-0", 900, "FF", "one") + # an older run of "one"
+          test_msgs("q-1", 1000, "PFS", "one") +
+          test_msgs("q-2", 2000, "", "two", finish = False) + [
+          { "msg-type": "phase-begin", "test-id": "q-1", "phase-no": 0,
+            "phase-name": "setup", "timestamp": 1000.5 },
+          { "msg-type": "phase-end", "test-id": "q-1", "phase-no": 0,
+            "phase-status": "ok", "timestamp": 1001.5 } ])
+db.close()
+
+def tadaq(*args):
+    return subprocess.check_output([ sys.executable, TADAQ,
+                                     "--db-path", db_path, "--test-user", "*",
+                                     "--commit-id", "c0" ] + list(args),
+                                   cwd = wd).decode()
+
+# jsonl: an object per test (the latest runs), with phases and assertions
+objs = [ json.loads(l) for l in tadaq("--format", "jsonl").splitlines() ]
+assert([ o["test_id"] for o in objs ] == [ "q-1", "q-2" ])
+one, two = objs
+assert(one["duration"] == 10 and one["test_status"] == "finished")
+assert([ (p["phase_name"], p["duration"]) for p in one["phases"] ] == \
+       [ ("setup", 1.0) ])
+assert([ (a["assert_id"], a["assert_result"], a["assert_time"]) \
+         for a in one["assertions"] ] == [ ("1", "passed", 2.0),
+                                           ("2", "failed", 2.0),
+                                           ("3", "skipped", 2.0) ])
+assert(one["assertions"][0]["assert_desc"] == 'a <"1">, & b')
+assert(two["test_status"] == "incomplete" and two["assertions"] == [])
+objs = [ json.loads(l) for l in \
+         tadaq("--format", "jsonl", "--all").splitlines() ]
+assert([ o["test_id"] for o in objs ] == [ "q-0", "q-1", "q-2" ])
+
+# csv: a row per assertion, a row for the incomplete test
+rows = list(csv.DictReader(io.StringIO(tadaq("--format", "csv"))))
+assert([ (r["test_id"], r["assert_id"]) for r in rows ] == \
+       [ ("q-1", "1"), ("q-1", "2"), ("q-1", "3"), ("q-2", "") ])
+# --only-failed shows the tests with a failed assertion ...
+rows = list(csv.DictReader(io.StringIO(tadaq("--format", "csv",
+                                             "--only-failed"))))
+assert([ (r["test_id"], r["assert_id"], r["assert_result"]) for r in rows ] \
+       == [ ("q-1", "2", "failed") ])
+assert(rows[0]["assert_desc"] == 'a <"2">, & b' and rows[0]["duration"] == "10")
+# ... and the incomplete tests only with --include-incomplete
+rows = list(csv.DictReader(io.StringIO(tadaq("--format", "csv",
+                                             "--only-failed",
+                                             "--include-incomplete"))))
+assert([ (r["test_id"], r["assert_id"], r["assert_result"]) for r in rows ] \
+       == [ ("q-1", "2", "failed"), ("q-2", "", "") ])
+
+# junit: a testsuite per test, a testcase per assertion
+root = ET.fromstring(tadaq("--format", "junit"))
+assert(root.tag == "testsuites")
+one, two = root.findall("testsuite")
+assert(one.get("name") == "SUITE.one")
+assert((one.get("tests"), one.get("failures"), one.get("skipped"),
+        one.get("errors")) == ("3", "1", "1", "0"))
+cases = one.findall("testcase")
+assert([ c.get("name") for c in cases ] == [ '1: a <"1">, & b',
+                                             '2: a <"2">, & b',
+                                             '3: a <"3">, & b' ])
+assert(cases[1].find("failure").get("message") == "x == 2")
+assert(cases[2].find("skipped") is not None)
+props = { p.get("name"): p.get("value") for p in one.iter("property") }
+assert(props["test_id"] == "q-1" and props["commit_id"] == "c0")
+assert((two.get("tests"), two.get("errors")) == ("1", "1"))
+assert(two.find("testcase/error") is not None)
+print("OK")